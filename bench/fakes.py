@@ -0,0 +1,176 @@
+"""
+Local stand-ins for moss and impala, good enough to drive smuggler in
+benchmarks. They implement the endpoints smuggler calls, answer 409 for
+objects that already exist just like the real services, can add a fixed
+latency to every request, and count what they were asked to do.
+"""
+import json
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handler, latency=0.0):
+        super().__init__(('127.0.0.1', 0), handler)
+        self.latency = latency
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+    @property
+    def uri(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.calls[name] += n
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            data = b''
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return data
+                data += self.rfile.read(size)
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _send(self, status, body=None, headers=None):
+        data = json.dumps(body).encode() if body is not None else b''
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _delay(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+
+class MossHandler(_Handler):
+    """
+    PUT /<hid>/music/<path>, /<hid>/albumart and /<hid>/lock.
+    """
+    def do_PUT(self):
+        self._delay()
+        parts = urlparse(self.path).path.strip('/').split('/')
+        body = self._body()
+        kind = parts[1] if len(parts) > 1 else ''
+        self.server.count('PUT ' + kind)
+        self.server.count('bytes', len(body))
+        self._send(201 if kind != 'lock' else 200, {})
+
+    def do_HEAD(self):
+        self._delay()
+        self.server.count('HEAD')
+        self._send(404)
+
+
+class ImpalaHandler(_Handler):
+    """
+    The subset of impala's API that ImpalaSession uses.
+    """
+    def _form(self):
+        body = self._body()
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            return json.loads(body.decode())
+        return {k: v[0] for k, v in parse_qs(body.decode()).items()}
+
+    def do_GET(self):
+        self._delay()
+        url = urlparse(self.path)
+        self.server.count('GET ' + url.path)
+        if url.path == '/api/v1/login':
+            self._send(200, {}, {'Set-Cookie': 'session={}; Path=/'.format(
+                uuid.uuid4().hex)})
+        elif url.path == '/api/v1/logout':
+            self._send(200, {})
+        elif url.path == '/api/v1/holdings/search':
+            infohash = parse_qs(url.query).get('torrent_hash', [''])[0]
+            hid = self.server.torrents.get(infohash)
+            self._send(200, {'results': [{'id': hid}] if hid else []})
+        else:
+            self._send(404)
+
+    def do_PUT(self):
+        self._delay()
+        path = urlparse(self.path).path
+        data = self._form()
+        self.server.count('PUT ' + path)
+        collection = path.rsplit('/', 1)[-1]
+
+        if collection == 'track_metadata':
+            if isinstance(data, list) and not self.server.bulk_metadata:
+                self._send(400)
+                return
+            self._send(201, {})
+        elif collection == 'tracks':
+            if data.get('holding_id') not in self.server.objects['holdings']:
+                self._send(404)
+                return
+            track_id = str(uuid.uuid4())
+            self.server.objects['tracks'].add(track_id)
+            self._send(201, {'id': track_id})
+        elif collection in self.server.objects:
+            with self.server.lock:
+                objects = self.server.objects[collection]
+                exists = data.get('id') in objects
+                objects.add(data.get('id'))
+            self._send(409 if exists else 201, {'id': data.get('id')})
+        else:
+            self._send(404)
+
+    def do_DELETE(self):
+        self._delay()
+        collection, _, object_id = urlparse(self.path).path.rpartition('/')
+        collection = collection.rsplit('/', 1)[-1]
+        self.server.count('DELETE /api/v1/' + collection)
+        with self.server.lock:
+            objects = self.server.objects.get(collection, set())
+            exists = object_id in objects
+            objects.discard(object_id)
+        self._send(204 if exists else 404)
+
+    def do_PATCH(self):
+        self._delay()
+        path = urlparse(self.path).path
+        data = self._form()
+        self.server.count('PATCH /api/v1/holdings')
+        if data.get('torrent_hash'):
+            self.server.torrents[data['torrent_hash']] = path.rsplit('/', 1)[-1]
+        self._send(200, {})
+
+
+def fake_moss(latency=0.0):
+    return FakeServer(MossHandler, latency).start()
+
+
+def fake_impala(latency=0.0, bulk_metadata=False):
+    server = FakeServer(ImpalaHandler, latency)
+    server.bulk_metadata = bulk_metadata
+    server.objects = {'formats': set(), 'stacks': set(),
+                      'holding_groups': set(), 'holdings': set(),
+                      'tracks': set()}
+    server.torrents = {}
+    return server.start()
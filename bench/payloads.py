@@ -0,0 +1,60 @@
+"""
+Synthetic FLAC, MP3 and JPEG files of a given size. The tags and headers
+are real enough for mutagen to parse; the audio itself is padding.
+"""
+import struct
+
+
+def _vorbis_comment(tags):
+    vendor = b'smuggler bench'
+    data = struct.pack('<I', len(vendor)) + vendor
+    data += struct.pack('<I', len(tags))
+    for key, value in tags.items():
+        entry = '{}={}'.format(key, value).encode()
+        data += struct.pack('<I', len(entry)) + entry
+    return data
+
+
+def flac(size, tags):
+    # 44.1 kHz, stereo, 16 bit, no total sample count
+    streaminfo = struct.pack('>HH', 4096, 4096) + b'\x00' * 6
+    streaminfo += ((44100 << 44) | (1 << 41) | (15 << 36)).to_bytes(8, 'big')
+    streaminfo += b'\x00' * 16
+    comment = _vorbis_comment(tags)
+
+    data = b'fLaC'
+    data += bytes([0]) + len(streaminfo).to_bytes(3, 'big') + streaminfo
+    data += bytes([0x80 | 4]) + len(comment).to_bytes(3, 'big') + comment
+    # An audio frame sync code so the stream looks plausible
+    data += b'\xff\xf8' + b'\x00' * 14
+    return data + b'\x00' * max(0, size - len(data))
+
+
+def _id3_frame(frame_id, text):
+    body = b'\x03' + text.encode()
+    size = len(body)
+    syncsafe = ((size & 0x7f) | ((size & 0x3f80) << 1) |
+                ((size & 0x1fc000) << 2) | ((size & 0xfe00000) << 3))
+    return frame_id.encode() + syncsafe.to_bytes(4, 'big') + b'\x00\x00' + body
+
+
+def mp3(size, tags):
+    names = {'title': 'TIT2', 'artist': 'TPE1', 'album': 'TALB',
+             'albumartist': 'TPE2', 'tracknumber': 'TRCK',
+             'discnumber': 'TPOS'}
+    frames = b''.join(_id3_frame(names[k], str(v))
+                      for k, v in tags.items() if k in names)
+    n = len(frames)
+    header = b'ID3\x04\x00\x00' + bytes([(n >> 21) & 0x7f, (n >> 14) & 0x7f,
+                                         (n >> 7) & 0x7f, n & 0x7f])
+    data = header + frames
+
+    # MPEG-1 layer III, 128 kbps, 44.1 kHz frames are 417 bytes long
+    frame = b'\xff\xfb\x90\x64' + b'\x00' * 413
+    count = max(1, (size - len(data)) // len(frame))
+    return data + frame * count
+
+
+def jpeg(size):
+    data = b'\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00'
+    return data + b'\x00' * max(0, size - len(data) - 2) + b'\xff\xd9'
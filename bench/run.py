@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+"""
+Benchmarks smuggler against local fake moss and impala servers.
+
+smuggler runs in a process of its own on a threaded development server,
+while the client and the fakes run in this one. Albums of synthetic tracks
+are uploaded at the given concurrency, each followed by its album art, a
+lock and a torrent lookup. The report covers requests/s, MB/s, p50/p99
+latency per endpoint, the smuggler process's peak RSS and how many calls
+reached each upstream. Results can be saved as a baseline and later runs compared
+against it, failing if the hot path has regressed.
+"""
+import argparse
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+import fakes      # noqa: E402
+import payloads   # noqa: E402
+
+USER = ('bench', 'bench')
+
+
+def _configure(args, moss, impala):
+    """
+    Points smuggler at the fakes through a generated config file, which has
+    to exist before smuggler is first imported.
+    """
+    temp_dir = tempfile.mkdtemp(prefix='smuggler-bench-')
+    config = os.path.join(temp_dir, 'config.py')
+    with open(config, 'w') as f:
+        f.write('TEMP_DIR = {!r}\n'.format(os.path.join(temp_dir, 'spool')))
+        f.write('MOSS_URI = {!r}\n'.format(moss.uri.replace(
+            'http://', 'http://admin:hunter2@')))
+        f.write('IMPALA_SERVER = {!r}\n'.format(
+            {'uri': impala.uri, 'username': 'smuggler', 'password': 'x'}))
+        f.write('ALLOWED_USERS = {!r}\n'.format(dict([USER])))
+        # Let every client thread have an upload in progress at once
+        f.write('USER_LIMITS = {!r}\n'.format(
+            {USER[0]: {'concurrency': args.concurrency}}))
+        f.write('MIN_FREE_SPACE = 0\n')
+        f.write('IMPALA_BULK_METADATA = {!r}\n'.format(args.impala_bulk))
+        for setting in args.set or []:
+            f.write(setting + '\n')
+    os.environ['APP_CONFIG_PATH'] = config
+
+
+def _serve(asgi=False):
+    if asgi:
+        return _serve_asgi()
+
+    from werkzeug.serving import make_server
+    from smuggler import app
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return 'http://127.0.0.1:{}'.format(server.server_port)
+
+
+def _serve_asgi():
+    import socket
+    import uvicorn
+    from smuggler.asgi import application
+
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    config = uvicorn.Config(application, log_level='warning')
+    server = uvicorn.Server(config)
+    threading.Thread(target=server.run, kwargs={'sockets': [sock]},
+                     daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return 'http://127.0.0.1:{}'.format(sock.getsockname()[1])
+
+
+def _start_server(asgi):
+    """
+    Starts smuggler in a child process, so that its peak RSS leaves out the
+    client and the fakes, and returns the process and smuggler's URL.
+    """
+    command = [sys.executable, os.path.abspath(__file__), '--child-serve']
+    if asgi:
+        command.append('--asgi')
+    proc = subprocess.Popen(command, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE)
+    url = proc.stdout.readline().decode().strip()
+    if not url:
+        proc.wait()
+        raise RuntimeError("smuggler exited with {}".format(proc.returncode))
+    return proc, url
+
+
+def _stop_server(proc):
+    """
+    Tells the child started by _start_server to exit, and returns its peak
+    RSS in MB.
+    """
+    out, _ = proc.communicate()
+    return float(out.decode())
+
+
+def _child_serve(asgi):
+    print(_serve(asgi), flush=True)
+    # Serve until the parent closes our stdin
+    sys.stdin.read()
+    # ru_maxrss is in kilobytes on Linux
+    print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = {}
+        self.errors = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def request(self, http, name, method, url, data=None, **kwargs):
+        start = time.perf_counter()
+        r = http.request(method, url, data=data, auth=USER, **kwargs)
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.latencies.setdefault(name, []).append(elapsed)
+            if data:
+                self.bytes += len(data)
+            if r.status_code >= 400 and r.status_code != 404:
+                self.errors += 1
+        return r
+
+
+def _album(server, recorder, args, n):
+    http = requests.Session()
+    hgid, hid = uuid.uuid4(), uuid.uuid4()
+    make = payloads.flac if n % 2 == 0 else payloads.mp3
+    ext = 'flac' if make is payloads.flac else 'mp3'
+
+    for track in range(1, args.tracks + 1):
+        tags = {'title': 'Track {}'.format(track), 'artist': 'Bench',
+                'album': 'Album {}'.format(n), 'tracknumber': str(track)}
+        path = quote('{:02d} Track.{}'.format(track, ext))
+        recorder.request(http, 'upload_track', 'PUT',
+                         '{}/api/v1/holding_groups/{}/{}/music/{}'.format(
+                             server, hgid, hid, path),
+                         make(args.size, tags))
+
+    recorder.request(http, 'upload_albumart', 'PUT',
+                     '{}/api/v1/holdings/{}/albumart'.format(server, hid),
+                     payloads.jpeg(args.art_size))
+    recorder.request(http, 'lock_holding', 'PUT',
+                     '{}/api/v1/holdings/{}/lock'.format(server, hid))
+    recorder.request(http, 'get_torrent', 'GET',
+                     '{}/api/v1/torrents/{}'.format(server, uuid.uuid4().hex))
+
+
+def run(args):
+    moss = fakes.fake_moss(args.latency)
+    impala = fakes.fake_impala(args.latency, bulk_metadata=args.impala_bulk)
+    _configure(args, moss, impala)
+    proc, server = _start_server(args.asgi)
+    recorder = Recorder()
+
+    try:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            for future in [pool.submit(_album, server, recorder, args, n)
+                           for n in range(args.albums)]:
+                future.result()
+        elapsed = time.perf_counter() - start
+    except:
+        proc.kill()
+        proc.wait()
+        raise
+    peak_rss_mb = _stop_server(proc)
+
+    requests_total = sum(len(v) for v in recorder.latencies.values())
+    return {
+        'workload': {key: value for key, value in vars(args).items()
+                     if key not in ('save_baseline', 'baseline', 'tolerance')},
+        'elapsed': elapsed,
+        'requests': requests_total,
+        'errors': recorder.errors,
+        'requests_per_second': requests_total / elapsed,
+        'mb_per_second': recorder.bytes / elapsed / 1e6,
+        'latency': {name: {'p50': _percentile(values, 50),
+                           'p99': _percentile(values, 99)}
+                    for name, values in sorted(recorder.latencies.items())},
+        'peak_rss_mb': peak_rss_mb,
+        'moss_calls': dict(moss.calls),
+        'impala_calls': dict(impala.calls),
+    }
+
+
+def compare(result, baseline, tolerance):
+    """
+    Returns a list of ways result is worse than baseline by more than the
+    given fraction.
+    """
+    if result['workload'] != baseline.get('workload'):
+        return ['workload differs from the baseline\'s; not comparable']
+
+    problems = []
+
+    def worse(name, new, old, higher_is_better=False):
+        if not old:
+            return
+        change = (old - new) / old if higher_is_better else (new - old) / old
+        if change > tolerance:
+            problems.append('{}: {:.4g} vs baseline {:.4g}'.format(
+                name, new, old))
+
+    worse('requests_per_second', result['requests_per_second'],
+          baseline['requests_per_second'], higher_is_better=True)
+    worse('mb_per_second', result['mb_per_second'],
+          baseline['mb_per_second'], higher_is_better=True)
+    worse('peak_rss_mb', result['peak_rss_mb'], baseline['peak_rss_mb'])
+    for name, latency in result['latency'].items():
+        if name in baseline['latency']:
+            worse(name + ' p99', latency['p99'],
+                  baseline['latency'][name]['p99'])
+    # Upstream call counts are deterministic, so any increase is a regression
+    for upstream in ['moss_calls', 'impala_calls']:
+        for call, count in result[upstream].items():
+            if count > baseline[upstream].get(call, 0) and call != 'bytes':
+                problems.append('{} {}: {} vs baseline {}'.format(
+                    upstream, call, count, baseline[upstream].get(call, 0)))
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--albums', type=int, default=8)
+    parser.add_argument('--tracks', type=int, default=10,
+                        help="Tracks per album")
+    parser.add_argument('--size', type=int, default=8 * 1024 * 1024,
+                        help="Bytes per track")
+    parser.add_argument('--art-size', type=int, default=2 * 1024 * 1024,
+                        help="Bytes of album art")
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help="Albums uploaded at the same time")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="Seconds added to every upstream request")
+    parser.add_argument('--impala-bulk', action='store_true',
+                        help="Fake impala accepts bulk track_metadata")
+    parser.add_argument('--asgi', action='store_true',
+                        help="Serve smuggler.asgi with uvicorn instead of "
+                             "the WSGI app")
+    parser.add_argument('--set', action='append', metavar='SETTING',
+                        help="Extra smuggler config line, e.g. "
+                             "'INGEST_THREADS = 8'")
+    parser.add_argument('--save-baseline', metavar='FILE')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help="Fail if worse than this saved run")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="Allowed fractional regression (default 0.2)")
+    parser.add_argument('--child-serve', action='store_true',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child_serve:
+        _child_serve(args.asgi)
+        return
+    del args.child_serve
+
+    result = run(args)
+    print(json.dumps(result, indent=2))
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(result, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            problems = compare(result, json.load(f), args.tolerance)
+        for problem in problems:
+            print('REGRESSION ' + problem, file=sys.stderr)
+        if problems:
+            sys.exit(1)
+
+    if result['errors']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+"""
+Benchmarks how quickly smuggler starts and how much memory each worker
+costs.
+
+Importing smuggler is timed in fresh interpreters, as is a cold start: from
+launching the interpreter to serving its first request. The import must not
+load any of HEAVY_MODULES, which smuggler only needs on first use or under
+ASGI. Then a master process loads the app, preloading as a uWSGI master
+would, and forks workers that each serve a request and read the tags of a
+track; the memory each worker does not share with the master is reported.
+Results can be saved as a baseline and later runs compared against it,
+failing if startup has regressed.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+
+USER = ('bench', 'bench')
+
+# Modules that importing smuggler must leave unloaded
+HEAVY_MODULES = ['asyncio', 'asgiref', 'beets', 'concurrent.futures.process',
+                 'mutagen', 'PIL', 'uvicorn']
+
+
+def _configure(args, temp_dir, preload):
+    os.makedirs(temp_dir)
+    config = os.path.join(temp_dir, 'config.py')
+    with open(config, 'w') as f:
+        f.write('TEMP_DIR = {!r}\n'.format(os.path.join(temp_dir, 'spool')))
+        f.write('ALLOWED_USERS = {!r}\n'.format(dict([USER])))
+        f.write('MIN_FREE_SPACE = 0\n')
+        f.write('PRELOAD = {!r}\n'.format(preload))
+        for setting in args.set or []:
+            f.write(setting + '\n')
+    env = dict(os.environ, APP_CONFIG_PATH=config)
+    paths = [ROOT_DIR, BENCH_DIR]
+    if env.get('PYTHONPATH'):
+        paths.append(env['PYTHONPATH'])
+    env['PYTHONPATH'] = os.pathsep.join(paths)
+    return env
+
+
+def _child(env, *args):
+    r = subprocess.run([sys.executable, os.path.abspath(__file__)] +
+                       list(args), env=env, stdout=subprocess.PIPE,
+                       stderr=subprocess.PIPE, check=True)
+    return r
+
+
+def measure_import(env):
+    """
+    Returns the milliseconds spent importing smuggler, as reported by
+    -X importtime, and the heavy modules it loaded.
+    """
+    r = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                        'import sys, json, smuggler; print(json.dumps('
+                        '[m for m in {!r} if m in sys.modules]))'.format(
+                            HEAVY_MODULES)],
+                       env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                       check=True)
+    for line in r.stderr.decode().splitlines():
+        fields = [field.strip() for field in line.split('|')]
+        if len(fields) == 3 and fields[2] == 'smuggler':
+            return int(fields[1]) / 1000, json.loads(r.stdout.decode())
+    raise RuntimeError("No import time for smuggler in:\n" + r.stderr.decode())
+
+
+def measure_cold_start(env):
+    """
+    Returns the milliseconds from starting an interpreter to smuggler
+    having served its first request.
+    """
+    start = time.perf_counter()
+    r = _child(env, '--child-first-request')
+    elapsed = time.perf_counter() - start
+    status = int(r.stdout.decode())
+    if status != 200:
+        raise RuntimeError("First request got {}".format(status))
+    return elapsed * 1000
+
+
+def measure_workers(env, workers):
+    """
+    Returns the master's RSS and each worker's private memory, in MB.
+    """
+    r = _child(env, '--child-workers', str(workers))
+    return json.loads(r.stdout.decode())
+
+
+def _memory_mb(fields):
+    """
+    Sums fields of /proc/self/smaps_rollup, in MB.
+    """
+    total = 0
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            name, _, value = line.partition(':')
+            if name in fields:
+                total += int(value.split()[0])
+    return total / 1024
+
+
+def _first_request():
+    import smuggler
+    client = smuggler.app.test_client()
+    r = client.get('/api/v1/spool', headers=_auth_headers())
+    return r.status_code
+
+
+def _auth_headers():
+    import base64
+    credentials = base64.b64encode(':'.join(USER).encode()).decode()
+    return {'Authorization': 'Basic ' + credentials}
+
+
+def _worker(track):
+    from smuggler import app
+    from smuggler.metadata import read_metadata
+    with app.app_context():
+        read_metadata(track)
+    _first_request()
+    return _memory_mb(['Private_Clean', 'Private_Dirty'])
+
+
+def _run_workers(count):
+    """
+    Loads smuggler, forks count workers from this process as uWSGI does, and
+    prints the memory figures as JSON.
+    """
+    import importlib
+    import payloads
+    importlib.import_module('smuggler')
+
+    track = os.path.join(tempfile.mkdtemp(prefix='smuggler-startup-'),
+                         'track.flac')
+    with open(track, 'wb') as f:
+        f.write(payloads.flac(64 * 1024, {'title': 'startup'}))
+
+    pids = []
+    pipes = []
+    for _ in range(count):
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read)
+            try:
+                os.write(write, str(_worker(track)).encode())
+            finally:
+                os._exit(0)
+        os.close(write)
+        pids.append(pid)
+        pipes.append(read)
+
+    private = []
+    for pid, read in zip(pids, pipes):
+        with os.fdopen(read) as f:
+            private.append(float(f.read()))
+        os.waitpid(pid, 0)
+    os.unlink(track)
+    print(json.dumps({'master_rss_mb': _memory_mb(['Rss']),
+                      'worker_private_mb': private}))
+
+
+def run(args):
+    temp_dir = tempfile.mkdtemp(prefix='smuggler-startup-')
+    lazy_env = _configure(args, os.path.join(temp_dir, 'lazy'), False)
+    preload_env = _configure(args, os.path.join(temp_dir, 'preload'), True)
+
+    import_ms = []
+    heavy = set()
+    for _ in range(args.runs):
+        ms, loaded = measure_import(lazy_env)
+        import_ms.append(ms)
+        heavy.update(loaded)
+    cold_start_ms = [measure_cold_start(lazy_env) for _ in range(args.runs)]
+    memory = measure_workers(preload_env, args.workers)
+
+    return {
+        'workload': {key: value for key, value in vars(args).items()
+                     if key not in ('save_baseline', 'baseline', 'tolerance',
+                                    'budget_ms')},
+        'import_ms': statistics.median(import_ms),
+        'cold_start_ms': statistics.median(cold_start_ms),
+        'heavy_modules_imported': sorted(heavy),
+        'master_rss_mb': memory['master_rss_mb'],
+        'worker_private_mb': max(memory['worker_private_mb']),
+    }
+
+
+def compare(result, baseline, tolerance):
+    """
+    Returns a list of ways result is worse than baseline by more than the
+    given fraction.
+    """
+    if result['workload'] != baseline.get('workload'):
+        return ['workload differs from the baseline\'s; not comparable']
+
+    problems = []
+    for name in ['import_ms', 'cold_start_ms', 'master_rss_mb',
+                 'worker_private_mb']:
+        new, old = result[name], baseline[name]
+        if old and (new - old) / old > tolerance:
+            problems.append('{}: {:.4g} vs baseline {:.4g}'.format(
+                name, new, old))
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=5,
+                        help="Interpreters to time; the median is reported")
+    parser.add_argument('--workers', type=int, default=4,
+                        help="Workers to fork from the master")
+    parser.add_argument('--set', action='append', metavar='SETTING',
+                        help="Extra smuggler config line, e.g. "
+                             "'METADATA_BACKENDS = [\"mutagen\"]'")
+    parser.add_argument('--budget-ms', type=float,
+                        help="Fail if importing smuggler takes longer")
+    parser.add_argument('--save-baseline', metavar='FILE')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help="Fail if worse than this saved run")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="Allowed fractional regression (default 0.2)")
+    parser.add_argument('--child-first-request', action='store_true',
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--child-workers', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child_first_request:
+        print(_first_request())
+        return
+    if args.child_workers:
+        _run_workers(args.child_workers)
+        return
+    del args.child_first_request, args.child_workers
+
+    result = run(args)
+    print(json.dumps(result, indent=2))
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(result, f, indent=2)
+
+    problems = ['{} imported by smuggler'.format(name)
+                for name in result['heavy_modules_imported']]
+    if args.budget_ms is not None and result['import_ms'] > args.budget_ms:
+        problems.append('import_ms: {:.4g} over budget of {:.4g}'.format(
+            result['import_ms'], args.budget_ms))
+    if args.baseline:
+        with open(args.baseline) as f:
+            problems += compare(result, json.load(f), args.tolerance)
+    for problem in problems:
+        print('REGRESSION ' + problem, file=sys.stderr)
+    if problems:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
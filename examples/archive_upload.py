@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+This is an example client for smuggler that uploads each album directory as
+a single streamed tar archive. smuggler unpacks it, uploads the album art,
+and locks the holding in the same request.
+"""
+import argparse
+import io
+import os
+import tarfile
+import threading
+import uuid
+import requests
+from urllib.parse import urljoin
+
+
+class _TarBody:
+    """
+    An uncompressed tar of an album directory, written through a pipe as it
+    is read. Its length is worked out from the member headers beforehand,
+    so that requests sends a Content-Length instead of a chunked body, which
+    smuggler needs to reserve spool space for it.
+    """
+    def __init__(self, path):
+        # Only used to build the TarInfo headers
+        probe = tarfile.open(fileobj=io.BytesIO(), mode='w')
+        self.members = []
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(dirs + files):
+                fullpath = os.path.join(root, name)
+                info = probe.gettarinfo(fullpath,
+                                        os.path.relpath(fullpath, path))
+                if info is not None:
+                    self.members.append((info, fullpath))
+
+        length = 2 * tarfile.BLOCKSIZE
+        for info, _ in self.members:
+            length += len(info.tobuf(probe.format, probe.encoding,
+                                     probe.errors))
+            if info.isreg():
+                length += -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        self.length = -(-length // tarfile.RECORDSIZE) * tarfile.RECORDSIZE
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        rfd, wfd = os.pipe()
+        writer = threading.Thread(target=self._write,
+                                  args=(os.fdopen(wfd, 'wb'),))
+        writer.start()
+        try:
+            with os.fdopen(rfd, 'rb') as fh:
+                yield from iter(lambda: fh.read(65536), b'')
+        finally:
+            writer.join()
+
+    def _write(self, fh):
+        with fh:
+            with tarfile.open(fileobj=fh, mode='w|') as archive:
+                for info, fullpath in self.members:
+                    if info.isreg():
+                        with open(fullpath, 'rb') as f:
+                            archive.addfile(info, f)
+                    else:
+                        archive.addfile(info)
+
+
+def upload_album(server, auth, path, debug=True):
+    """
+    Streams the album directory at path to smuggler as a new holding. The tar
+    is generated through a pipe, so the album is never held in memory.
+    """
+    hgid = uuid.uuid4()     # HoldingGroup UUID
+    hid = uuid.uuid4()      # Holding UUID
+    endpoint = urljoin(server, '/api/v1/holding_groups/{}/{}/archive'.format(
+        hgid, hid))
+    if debug:
+        print("PUT {}".format(endpoint))
+
+    r = requests.put(endpoint, auth=auth, data=_TarBody(path),
+                     headers={'Content-Type': 'application/x-tar'})
+
+    if r.status_code < 200 or r.status_code >= 300:
+        print("ERROR: {}".format(r.status_code))
+    return hid
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--server', required=True, help="URL to Smuggler server")
+    parser.add_argument('--user', required=True, help="Smuggler user")
+    parser.add_argument('--password', required=True, help="Smuggler password")
+    parser.add_argument('albums', nargs='+', help="Album directories")
+    args = parser.parse_args()
+
+    for album in args.albums:
+        upload_album(args.server, (args.user, args.password), album)
@@ -2,77 +2,35 @@
 """
 This is an example client for smuggler that uploads all completed torrents in a
 transmission download directory on localhost and locks them. Local files are
-not modified.
+not modified. Files are uploaded in parallel, and an interrupted run picks
+up where it left off using the manifest. To upload torrents as soon as they
+finish instead of on a schedule, run watch_upload.py.
 """
 import argparse
 import os
-from os.path import split
+import sys
 import requests
-import uuid
-from urllib.parse import urlparse, urljoin, quote
+from urllib.parse import urlparse, urljoin
 
 import transmissionrpc
+from uploader import Uploader
 
-ALBUMART_FILENAMES = ['folder.jpg', 'cover.jpg', 'front.jpg']
 
-
-def _put_resource(endpoint, auth, fullpath=None, debug=True):
-    if debug:
-        print("PUT {}".format(endpoint))
-
-    if fullpath:
-        with open(fullpath, 'rb') as fh:
-            r = requests.put(endpoint, auth=auth, data=fh)
-    else:
-        r = requests.put(endpoint, auth=auth)
-
-    if r.status_code < 200 or r.status_code >= 300:
-        print("ERROR: {}".format(r.status_code))
-
-
-def torrent_hash_exists(server, auth, torrent_hash):
-    endpoint = urljoin(server, '/api/v1/torrents/{}'.format(torrent_hash))
-    r = requests.get(endpoint, auth=auth)
-    if r.status_code == 404:
-        return False
-    elif r.status_code >= 200 and r.status_code < 300:
-        return True
-    else:
-        raise IOError("ERROR: {}".format(r.status_code))
-
-
-def upload_albumart(server, auth, hid, fullpath, debug=True):
+def existing_torrent_hashes(server, auth, torrent_hashes):
     """
-    Upload the album art to the server for the specified holding ID.
+    Returns the subset of torrent_hashes that already exist in impala, asking
+    the server about all of them at once.
     """
-    endpoint = urljoin(server, '/api/v1/holdings/{}/albumart'.format(hid))
-    return _put_resource(endpoint, auth, fullpath=fullpath, debug=debug)
-
-
-def upload_track(server, auth, hgid, hid, relpath, fullpath, debug=True):
-    """
-    Upload the track at fullpath to the smuggler server for the specified hgid,
-    hid, and relative path.
-    """
-    relpath = quote(relpath)
-    endpoint = urljoin(server, '/api/v1/holding_groups/{}/{}/music/{}'.format(
-        hgid, hid, relpath))
-    return _put_resource(endpoint, auth, fullpath=fullpath, debug=debug)
-
-
-def upload_source_metadata(server, auth, hid, metadata):
-    endpoint = urljoin(server, '/api/v1/holdings/{}/source'.format(hid))
-    r = requests.post(endpoint, auth=auth, data=metadata)
-    if r.status_code < 200 or r.status_code >= 300:
-        print("ERROR: {}".format(r.status_code))
-
-
-def lock_album(server, auth, hid, debug=True):
-    """
-    Lock the album so that tracks cannot be modified.
-    """
-    endpoint = urljoin(server, '/api/v1/holdings/{}/lock'.format(hid))
-    return _put_resource(endpoint, auth, fullpath=None, debug=debug)
+    endpoint = urljoin(server, '/api/v1/torrents/lookup')
+    existing = set()
+    torrent_hashes = list(torrent_hashes)
+    for start in range(0, len(torrent_hashes), 1000):
+        r = requests.post(endpoint, auth=auth,
+                          json=torrent_hashes[start:start + 1000])
+        if r.status_code < 200 or r.status_code >= 300:
+            raise IOError("ERROR: {}".format(r.status_code))
+        existing.update(h for h, hid in r.json()['results'].items() if hid)
+    return existing
 
 
 if __name__ == "__main__":
@@ -91,6 +49,13 @@ if __name__ == "__main__":
                         help="Transmission password")
     parser.add_argument('--limit-tracker', required=False,
                         help="Limit torrents to those on a specific tracker")
+    parser.add_argument('--workers', type=int, default=8,
+                        help="Files uploaded at the same time (default 8)")
+    parser.add_argument('--albums-at-once', type=int, default=4,
+                        help="Torrents in progress at the same time "
+                             "(default 4)")
+    parser.add_argument('--manifest', default='smuggler-manifest.jsonl',
+                        help="File recording completed uploads, for resuming")
     parser.add_argument('directory', help="Transmission download directory")
     args = parser.parse_args()
 
@@ -126,6 +91,9 @@ if __name__ == "__main__":
             'trackers': f['trackers'],
         }
 
+    existing = existing_torrent_hashes(server, auth, to_upload.keys())
+    albums = {}
+
     for hash, data in to_upload.items():
         path = data['path']
 
@@ -144,38 +112,19 @@ if __name__ == "__main__":
         metadata['torrent_hash'] = hash
         print(metadata)
 
-        hgid = uuid.uuid4()     # HoldingGroup UUID
-        hid = uuid.uuid4()      # Holding UUID
-
-        if torrent_hash_exists(server, auth, hash):
+        if hash.lower() in existing:
             print('Skipping ' + path + ': already exists in impala')
             continue
 
-        if os.path.isdir(path):
-            print('Found directory: ' + path)
-
-            for root, dirs, files in os.walk(path):
-                for name in files:
-                    fullpath = os.path.join(root, name)
-                    relpath = fullpath[len(path):]
-                    if relpath[0] == '/':
-                        relpath = relpath[1:]
-
-                    upload_track(server, auth, hgid, hid, relpath, fullpath)
-
-                    if split(relpath)[1].lower() in ALBUMART_FILENAMES:
-                        upload_albumart(server, auth, hid, fullpath)
-
-            lock_album(server, auth, hid)
-
-        elif os.path.isfile(path):
-            print('Found file: ' + path)
-
-            upload_track(server, auth, hgid, hid, data['name'], data['path'])
-            lock_album(server, auth, hid)
-
-        else:
+        if not os.path.exists(path):
             print('NOT A FILE: ' + path)
             continue
 
-        upload_source_metadata(server, auth, hid, metadata)
+        print('Found: ' + path)
+        albums[path] = metadata
+
+    uploader = Uploader(server, auth, workers=args.workers,
+                        manifest=args.manifest)
+    results = uploader.upload_albums(albums, args.albums_at_once)
+    if any(isinstance(r, Exception) for r in results.values()):
+        sys.exit(1)
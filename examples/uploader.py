@@ -0,0 +1,413 @@
+#!/usr/bin/env python3
+"""
+A parallel uploader for smuggler, usable as a library or from the command
+line. Files are sent by a bounded pool of workers over pooled keep-alive
+connections, both across albums and within an album. Transient failures are
+retried with exponential backoff, and each album is locked only once every
+one of its files has been uploaded.
+
+Completed files are recorded in a manifest, along with the holding each
+album was given, so an interrupted import can be re-run and will only send
+what is missing. When an album is resumed, smuggler is also asked which of
+its files it already has, and a file whose upload failed part-way is checked
+with a HEAD before it is sent again.
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from os.path import split
+from urllib.parse import urljoin, quote
+
+import requests
+from requests.adapters import HTTPAdapter
+
+ALBUMART_FILENAMES = ['folder.jpg', 'cover.jpg', 'front.jpg']
+
+# Worth trying again; anything else in the 4xx range is our fault
+RETRY_STATUSES = [408, 429, 500, 502, 503, 504]
+# Smuggler says how long to wait with these
+BUSY_STATUSES = [429, 503]
+
+
+class UploadError(IOError):
+    pass
+
+
+def _retry_after(value):
+    """
+    Returns the seconds to wait given by a Retry-After header, in either of
+    its forms, or None if there isn't a usable one.
+    """
+    if value.isdigit():
+        return int(value)
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when is None or when.tzinfo is None:
+        return None
+    return max(when.timestamp() - time.time(), 0)
+
+
+class Manifest:
+    """
+    An append-only JSON lines record of albums and the files in them that
+    have been uploaded.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.albums = {}
+        self.files = set()
+        self.lock = threading.Lock()
+
+        if path and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    entry = json.loads(line)
+                    if entry['type'] == 'album':
+                        self.albums[entry['path']] = entry
+                    elif entry['type'] == 'file':
+                        self.files.add(self._file_key(entry))
+
+    @staticmethod
+    def _file_key(entry):
+        return (entry['hid'], entry['relpath'], entry['size'], entry['mtime'])
+
+    def _append(self, entry):
+        if not self.path:
+            return
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+
+    def album(self, path):
+        """
+        Returns the album entry for path, creating new holding IDs for an
+        album we haven't seen before.
+        """
+        path = os.path.abspath(path)
+        with self.lock:
+            if path not in self.albums:
+                entry = {'type': 'album', 'path': path,
+                         'hgid': str(uuid.uuid4()), 'hid': str(uuid.uuid4()),
+                         'locked': False}
+                self.albums[path] = entry
+                self._append(entry)
+            return self.albums[path]
+
+    def is_done(self, hid, relpath, st):
+        return (hid, relpath, st.st_size, int(st.st_mtime)) in self.files
+
+    def file_done(self, hid, relpath, st):
+        entry = {'type': 'file', 'hid': hid, 'relpath': relpath,
+                 'size': st.st_size, 'mtime': int(st.st_mtime)}
+        with self.lock:
+            self.files.add(self._file_key(entry))
+            self._append(entry)
+
+    def album_locked(self, album):
+        with self.lock:
+            album['locked'] = True
+            self._append(album)
+
+
+class Progress:
+    """
+    Counts finished files and bytes, and prints a status line with the
+    current throughput every interval seconds.
+    """
+    def __init__(self, interval=2.0, stream=sys.stderr):
+        self.interval = interval
+        self.stream = stream
+        self.files = 0
+        self.total_files = 0
+        self.bytes = 0
+        self.start = time.monotonic()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def add_total(self, n):
+        with self.lock:
+            self.total_files += n
+
+    def file_done(self, size):
+        with self.lock:
+            self.files += 1
+            self.bytes += size
+
+    def line(self):
+        elapsed = max(time.monotonic() - self.start, 1e-6)
+        return '{}/{} files, {:.1f} MB, {:.2f} MB/s'.format(
+            self.files, self.total_files, self.bytes / 1e6,
+            self.bytes / elapsed / 1e6)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            print(self.line(), file=self.stream)
+
+    def __enter__(self):
+        threading.Thread(target=self._run, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        print(self.line(), file=self.stream)
+
+
+class Uploader:
+    def __init__(self, server, auth=None, workers=8, retries=5,
+                 backoff=1.0, manifest=None, debug=False, timeout=(10, 120)):
+        self.server = server
+        self.auth = auth
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        # (connect, read) seconds; the read timeout has to cover smuggler
+        # ingesting a file after its body has been sent
+        self.timeout = timeout
+        self.manifest = Manifest(manifest)
+        self.debug = debug
+        self.progress = Progress()
+
+        self.http = requests.Session()
+        self.http.auth = auth
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.http.mount('http://', adapter)
+        self.http.mount('https://', adapter)
+
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+
+    def request(self, method, path, fullpath=None, already_done=None,
+                **kwargs):
+        """
+        Sends a request to smuggler, retrying connection failures, timeouts
+        and retryable statuses with jittered exponential backoff. When
+        smuggler is busy, it waits as long as Retry-After says instead.
+        If already_done is given, it is called before each
+        retry and the request is abandoned if it returns True. Raises
+        UploadError if it never succeeds.
+        """
+        endpoint = urljoin(self.server, path)
+        kwargs.setdefault('timeout', self.timeout)
+        for attempt in range(self.retries + 1):
+            if attempt and already_done is not None and already_done():
+                return None
+            if self.debug:
+                print("{} {}".format(method, endpoint), file=sys.stderr)
+
+            delay = self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+            try:
+                if fullpath:
+                    with open(fullpath, 'rb') as fh:
+                        r = self.http.request(method, endpoint, data=fh,
+                                              **kwargs)
+                else:
+                    r = self.http.request(method, endpoint, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = str(e)
+            else:
+                if 200 <= r.status_code < 300:
+                    return r
+                error = "{} from {}".format(r.status_code, endpoint)
+                if r.status_code not in RETRY_STATUSES:
+                    break
+                retry_after = _retry_after(r.headers.get('Retry-After', ''))
+                if retry_after is not None:
+                    if r.status_code in BUSY_STATUSES:
+                        delay = retry_after
+                    else:
+                        delay = max(delay, retry_after)
+
+            if attempt < self.retries:
+                time.sleep(delay)
+
+        raise UploadError(error)
+
+    def _files(self, path):
+        """
+        Yields (relpath, fullpath) for every file in an album directory, or
+        for the album itself if it is a single file.
+        """
+        if os.path.isfile(path):
+            yield os.path.basename(path), path
+            return
+
+        for root, dirs, files in os.walk(path):
+            for name in files:
+                fullpath = os.path.join(root, name)
+                yield os.path.relpath(fullpath, path), fullpath
+
+    def _track_path(self, album, relpath):
+        return '/api/v1/holding_groups/{}/{}/music/{}'.format(
+            album['hgid'], album['hid'], quote(relpath))
+
+    def _is_stored(self, album, relpath, sha256):
+        """
+        Returns whether smuggler already has this exact file, according to
+        the ETag of a HEAD on its path.
+        """
+        try:
+            r = self.http.head(urljoin(self.server,
+                                       self._track_path(album, relpath)),
+                               timeout=self.timeout)
+        except (requests.ConnectionError, requests.Timeout):
+            return False
+        return r.status_code == 200 and \
+            r.headers.get('ETag', '').strip('"') == sha256
+
+    def _upload_file(self, album, relpath, fullpath, sha256=None):
+        st = os.stat(fullpath)
+        if self.manifest.is_done(album['hid'], relpath, st):
+            self.progress.file_done(0)
+            return
+
+        def already_done():
+            # The last attempt may have been stored even though we never
+            # heard back; if so there is no need to send it again
+            return self._is_stored(album, relpath,
+                                   sha256 or _sha256(fullpath))
+
+        self.request('PUT', self._track_path(album, relpath), fullpath,
+                     already_done=already_done)
+        if split(relpath)[1].lower() in ALBUMART_FILENAMES:
+            self.request('PUT', '/api/v1/holdings/{}/albumart'.format(
+                album['hid']), fullpath)
+
+        self.manifest.file_done(album['hid'], relpath, st)
+        self.progress.file_done(st.st_size)
+
+    def upload_album(self, path, source_metadata=None):
+        """
+        Uploads an album directory (or single file) and locks it once every
+        file has been uploaded, then sets its source metadata if given.
+        Returns the holding ID.
+        """
+        resumed = os.path.abspath(path) in self.manifest.albums
+        album = self.manifest.album(path)
+        if album['locked']:
+            return album['hid']
+
+        files = list(self._files(path))
+        self.progress.add_total(len(files))
+        hashes = {}
+        if resumed:
+            files, hashes = self._diff(album, files)
+
+        futures = [self.pool.submit(self._upload_file, album, relpath,
+                                    fullpath, hashes.get(relpath))
+                   for relpath, fullpath in files]
+        # Wait for everything before raising, so no upload is left running
+        errors = [f.exception() for f in futures]
+        errors = [e for e in errors if e is not None]
+        if errors:
+            raise errors[0]
+
+        self.request('PUT', '/api/v1/holdings/{}/lock'.format(album['hid']))
+        self.manifest.album_locked(album)
+
+        if source_metadata:
+            self.request('POST', '/api/v1/holdings/{}/source'.format(
+                album['hid']), data=source_metadata)
+        return album['hid']
+
+    def _diff(self, album, files):
+        """
+        Asks smuggler which of an album's files it doesn't have yet, and
+        returns those, along with the hashes computed for the question.
+        Files it already has are recorded as done.
+        """
+        pending = [(relpath, fullpath) for relpath, fullpath in files
+                   if not self.manifest.is_done(album['hid'], relpath,
+                                                os.stat(fullpath))]
+        hashes = dict(zip([relpath for relpath, _ in pending],
+                          self.pool.map(_sha256,
+                                        [fullpath for _, fullpath in pending])))
+        entries = [{'path': relpath, 'size': os.path.getsize(fullpath),
+                    'sha256': hashes[relpath]}
+                   for relpath, fullpath in pending]
+        if not entries:
+            return files, hashes
+
+        r = self.request('POST', '/api/v1/holdings/{}/manifest'.format(
+            album['hid']), json=entries)
+        needed = set(r.json()['missing']) | set(r.json()['changed'])
+
+        remaining = []
+        for relpath, fullpath in files:
+            # Album art is also sent separately, which the index doesn't see
+            if relpath in hashes and relpath not in needed and \
+                    split(relpath)[1].lower() not in ALBUMART_FILENAMES:
+                st = os.stat(fullpath)
+                self.manifest.file_done(album['hid'], relpath, st)
+                self.progress.file_done(0)
+            else:
+                remaining.append((relpath, fullpath))
+        return remaining, hashes
+
+    def upload_albums(self, paths, album_concurrency=4):
+        """
+        Uploads several albums at once, all sharing the same pool of file
+        workers. paths may also be a dict mapping each path to its source
+        metadata. Returns {path: hid or the exception that stopped it}.
+        """
+        if not isinstance(paths, dict):
+            paths = dict.fromkeys(paths)
+
+        results = {}
+        with self.progress, \
+                ThreadPoolExecutor(max_workers=album_concurrency) as albums:
+            futures = {path: albums.submit(self.upload_album, path, metadata)
+                       for path, metadata in paths.items()}
+            for path, future in futures.items():
+                try:
+                    results[path] = future.result()
+                except Exception as e:
+                    print("ERROR: {}: {}".format(path, e), file=sys.stderr)
+                    results[path] = e
+        return results
+
+
+def _sha256(path):
+    checksum = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--server', required=True, help="URL to Smuggler server")
+    parser.add_argument('--user', help="Smuggler user")
+    parser.add_argument('--password', help="Smuggler password")
+    parser.add_argument('--workers', type=int, default=8,
+                        help="Files uploaded at the same time (default 8)")
+    parser.add_argument('--albums-at-once', type=int, default=4,
+                        help="Albums in progress at the same time (default 4)")
+    parser.add_argument('--retries', type=int, default=5)
+    parser.add_argument('--connect-timeout', type=float, default=10,
+                        help="Seconds to wait for a connection (default 10)")
+    parser.add_argument('--read-timeout', type=float, default=120,
+                        help="Seconds to wait for smuggler to answer "
+                             "(default 120)")
+    parser.add_argument('--manifest', default='smuggler-manifest.jsonl',
+                        help="File recording completed uploads, for resuming")
+    parser.add_argument('--debug', action='store_true')
+    parser.add_argument('albums', nargs='+', help="Album directories")
+    args = parser.parse_args()
+
+    auth = (args.user, args.password) if args.user else None
+    uploader = Uploader(args.server, auth, workers=args.workers,
+                        retries=args.retries, manifest=args.manifest,
+                        debug=args.debug,
+                        timeout=(args.connect_timeout, args.read_timeout))
+    results = uploader.upload_albums(args.albums, args.albums_at_once)
+    if any(isinstance(r, Exception) for r in results.values()):
+        sys.exit(1)
@@ -0,0 +1,478 @@
+#!/usr/bin/env python3
+"""
+A long-running smuggler client that watches download directories and
+uploads each album in them once it is complete. Every file or directory
+directly inside a watched directory is one album, as Transmission lays them
+out.
+
+Changes are picked up with inotify when inotify_simple is installed, or by
+rescanning every --poll-interval seconds otherwise. An album is uploaded
+once none of its files have changed for --settle seconds, or as soon as
+Transmission reports its torrent as finished. For that, run the daemon
+with --listen and set Transmission's script-torrent-done-filename to a
+script that runs:
+
+    watch_upload.py --notify http://127.0.0.1:8765
+
+Albums that have been uploaded, or whose torrent impala already has, are
+recorded in a local state database and never looked at again. Given
+--transmission-port, the torrent behind each album is found through
+Transmission's RPC interface, so that albums impala already has are skipped
+even without a completion event; those already in the watched directories
+are all looked up at once on startup. Without Transmission, the albums
+present when the state database is created are assumed to have been
+uploaded before and are skipped, unless --upload-existing is given.
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from uploader import Uploader
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+DONE = 'done'
+EXISTS = 'exists'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+# Most infohashes smuggler accepts in one bulk torrent lookup
+LOOKUP_BATCH = 1000
+
+# Transmission's suffix for files that are still downloading
+PARTIAL_SUFFIX = '.part'
+
+
+class State:
+    """
+    What has happened to each album, by path, in a SQLite database.
+    """
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False,
+                                  isolation_level=None)
+        self.lock = threading.Lock()
+        self.created = self.db.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'albums'"
+        ).fetchone() is None
+        self.db.execute('CREATE TABLE IF NOT EXISTS albums ('
+                        'path TEXT PRIMARY KEY, status TEXT NOT NULL, '
+                        'hid TEXT, torrent_hash TEXT, error TEXT, '
+                        'updated REAL NOT NULL)')
+        self.finished = {row[0] for row in self.db.execute(
+            'SELECT path FROM albums WHERE status IN (?, ?, ?)',
+            (DONE, EXISTS, SKIPPED))}
+
+    def is_finished(self, path):
+        return path in self.finished
+
+    def record(self, path, status, hid=None, torrent_hash=None, error=None):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO albums (path, status, '
+                            'hid, torrent_hash, error, updated) '
+                            'VALUES (?, ?, ?, ?, ?, ?)',
+                            (path, status, hid, torrent_hash, error,
+                             time.time()))
+            if status in (DONE, EXISTS, SKIPPED):
+                self.finished.add(path)
+
+
+class Transmission:
+    """
+    Finds the torrent behind each album through Transmission's RPC
+    interface on localhost.
+    """
+    def __init__(self, port, user=None, password=None):
+        import transmissionrpc
+        self.client = transmissionrpc.Client(address='localhost', port=port,
+                                             user=user, password=password)
+        self.lock = threading.Lock()
+
+    def hashes(self, roots):
+        """
+        Returns {album: torrent hash} for every torrent downloaded directly
+        into one of roots.
+        """
+        with self.lock:
+            torrents = self.client.get_torrents(
+                arguments=['id', 'hashString', 'downloadDir', 'name'])
+        hashes = {}
+        for t in torrents:
+            f = t._fields
+            album = os.path.abspath(os.path.join(f['downloadDir'].value,
+                                                 f['name'].value))
+            if os.path.dirname(album) in roots:
+                hashes[album] = f['hashString'].value.lower()
+        return hashes
+
+
+class Watcher:
+    """
+    Keeps track of when each unfinished album under the watched roots last
+    changed, and hands out the ones that have settled.
+    """
+    def __init__(self, roots, state, settle):
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.state = state
+        self.settle = settle
+        self.changed = {}
+        self.metadata = {}
+        self.ready = set()
+        self.active = set()
+        self.lock = threading.Lock()
+
+    def album_of(self, path):
+        """
+        Returns the album a path belongs to, or None if it isn't under a
+        watched root.
+        """
+        path = os.path.abspath(path)
+        for root in self.roots:
+            if os.path.dirname(path) == root:
+                return path
+            if path.startswith(root + os.sep):
+                rest = path[len(root) + 1:]
+                return os.path.join(root, rest.split(os.sep, 1)[0])
+        return None
+
+    def touch(self, album, metadata=None, complete=False):
+        """
+        Notes that an album changed, or with complete that it is finished
+        and can be uploaded straight away.
+        """
+        if album is None or self.state.is_finished(album):
+            return
+        with self.lock:
+            self.changed[album] = time.monotonic()
+            if metadata:
+                self.metadata[album] = metadata
+            if complete:
+                self.ready.add(album)
+
+    def albums(self):
+        """
+        Yields every unfinished album currently in the watched roots.
+        """
+        for root in self.roots:
+            for name in os.listdir(root):
+                album = os.path.join(root, name)
+                if not self.state.is_finished(album):
+                    yield album
+
+    def due(self):
+        """
+        Returns (album, metadata) for each album that has settled and isn't
+        already being uploaded, and marks them as being uploaded.
+        """
+        now = time.monotonic()
+        due = []
+        with self.lock:
+            for album, changed in list(self.changed.items()):
+                if album in self.active:
+                    continue
+                if album not in self.ready and now - changed < self.settle:
+                    continue
+                if not os.path.exists(album) or _has_partial_files(album):
+                    continue
+                del self.changed[album]
+                self.ready.discard(album)
+                self.active.add(album)
+                due.append((album, self.metadata.pop(album, {})))
+        return due
+
+    def finished(self, album):
+        with self.lock:
+            self.active.discard(album)
+
+
+def _has_partial_files(path):
+    if os.path.isfile(path):
+        return path.endswith(PARTIAL_SUFFIX)
+    for _, _, files in os.walk(path):
+        if any(name.endswith(PARTIAL_SUFFIX) for name in files):
+            return True
+    return False
+
+
+def _signature(path):
+    """
+    Returns something that changes whenever a file in path does.
+    """
+    if os.path.isfile(path):
+        st = os.stat(path)
+        return (1, st.st_size, st.st_mtime)
+    count = size = mtime = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                st = os.stat(os.path.join(root, name))
+            except FileNotFoundError:
+                continue
+            count += 1
+            size += st.st_size
+            mtime = max(mtime, st.st_mtime)
+    return (count, size, mtime)
+
+
+class InotifySource:
+    """
+    Reports changes under the watched roots as inotify sees them, watching
+    new subdirectories as they appear.
+    """
+    def __init__(self, watcher):
+        flags = inotify_simple.flags
+        self.watcher = watcher
+        self.mask = (flags.CREATE | flags.MODIFY | flags.CLOSE_WRITE |
+                     flags.MOVED_TO | flags.MOVED_FROM | flags.DELETE)
+        self.inotify = inotify_simple.INotify()
+        self.paths = {}
+
+        for root in watcher.roots:
+            self._watch(root, recursive=False)
+        for album in watcher.albums():
+            self._watch(album)
+            watcher.touch(album)
+
+    def _watch(self, path, recursive=True):
+        if not os.path.isdir(path):
+            return
+        self.paths[self.inotify.add_watch(path, self.mask)] = path
+        if recursive:
+            for root, dirs, _ in os.walk(path):
+                for name in dirs:
+                    full = os.path.join(root, name)
+                    self.paths[self.inotify.add_watch(full, self.mask)] = full
+
+    def wait(self, timeout):
+        for event in self.inotify.read(timeout=int(timeout * 1000)):
+            parent = self.paths.get(event.wd)
+            if parent is None:
+                continue
+            path = os.path.join(parent, event.name)
+            album = self.watcher.album_of(path)
+            if album is None or self.watcher.state.is_finished(album):
+                continue
+            if event.mask & inotify_simple.flags.ISDIR and \
+                    event.mask & (inotify_simple.flags.CREATE |
+                                  inotify_simple.flags.MOVED_TO):
+                self._watch(path)
+            self.watcher.touch(album)
+
+
+class PollingSource:
+    """
+    Reports changes under the watched roots by comparing each unfinished
+    album's files every interval seconds.
+    """
+    def __init__(self, watcher, interval):
+        self.watcher = watcher
+        self.interval = interval
+        self.signatures = {}
+        self.next_scan = 0
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+        if time.monotonic() < self.next_scan:
+            return
+        self.next_scan = time.monotonic() + self.interval
+
+        for album in self.watcher.albums():
+            signature = _signature(album)
+            if self.signatures.get(album) != signature:
+                self.signatures[album] = signature
+                self.watcher.touch(album)
+
+
+class _CompletionHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            event = json.loads(self.rfile.read(length).decode())
+            album = os.path.join(event['dir'], event['name'])
+        except (ValueError, KeyError, TypeError):
+            self.send_response(400)
+            self.end_headers()
+            return
+
+        metadata = {}
+        if event.get('hash'):
+            metadata['torrent_hash'] = event['hash'].lower()
+        self.server.watcher.touch(os.path.abspath(album), metadata,
+                                  complete=True)
+        self.send_response(204)
+        self.end_headers()
+
+
+def listen(address, watcher):
+    """
+    Accepts torrent completion events, sent by --notify, on host:port.
+    """
+    host, _, port = address.rpartition(':')
+    server = ThreadingHTTPServer((host or '127.0.0.1', int(port)),
+                                 _CompletionHandler)
+    server.daemon_threads = True
+    server.watcher = watcher
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def notify(url):
+    """
+    Reports the torrent Transmission has just finished, from the
+    environment it gives its done script, to a running daemon.
+    """
+    event = {'dir': os.environ['TR_TORRENT_DIR'],
+             'name': os.environ['TR_TORRENT_NAME'],
+             'hash': os.environ.get('TR_TORRENT_HASH', '')}
+    requests.post(url, json=event, timeout=10).raise_for_status()
+
+
+def existing_torrents(uploader, torrent_hashes):
+    """
+    Returns the subset of torrent_hashes that impala already has, asking
+    smuggler about up to LOOKUP_BATCH of them at a time.
+    """
+    existing = set()
+    torrent_hashes = list(torrent_hashes)
+    for start in range(0, len(torrent_hashes), LOOKUP_BATCH):
+        r = uploader.request('POST', '/api/v1/torrents/lookup',
+                             json=torrent_hashes[start:start + LOOKUP_BATCH])
+        existing.update(h for h, hid in r.json()['results'].items() if hid)
+    return existing
+
+
+def seed(uploader, state, watcher, transmission, upload_existing):
+    """
+    Records which of the albums already in the watched roots need no
+    upload, before any of them are considered: those whose torrent impala
+    has, and on the first run, unless upload_existing, those whose torrent
+    can't be found.
+    """
+    albums = list(watcher.albums())
+    hashes = transmission.hashes(watcher.roots) if transmission else {}
+    existing = existing_torrents(uploader, {hashes[album] for album in albums
+                                            if album in hashes})
+    for album in albums:
+        torrent_hash = hashes.get(album)
+        if torrent_hash in existing:
+            state.record(album, EXISTS, torrent_hash=torrent_hash)
+        elif torrent_hash is None and state.created and not upload_existing:
+            state.record(album, SKIPPED)
+    skipped = sum(1 for album in albums if album in state.finished)
+    if skipped:
+        print('Skipping {} of the {} albums already present'.format(
+            skipped, len(albums)))
+
+
+def upload(uploader, state, watcher, transmission, album, metadata):
+    torrent_hash = metadata.get('torrent_hash')
+    try:
+        if not torrent_hash and transmission is not None:
+            torrent_hash = transmission.hashes(watcher.roots).get(album)
+            if torrent_hash:
+                metadata = dict(metadata, torrent_hash=torrent_hash)
+
+        if torrent_hash and existing_torrents(uploader, [torrent_hash]):
+            print('Skipping {}: already exists in impala'.format(album))
+            state.record(album, EXISTS, torrent_hash=torrent_hash)
+            return
+
+        print('Uploading {}'.format(album))
+        hid = uploader.upload_album(album, metadata or None)
+        state.record(album, DONE, hid=hid, torrent_hash=torrent_hash)
+        print('Uploaded {} as {}'.format(album, hid))
+    except Exception as e:
+        # Left unfinished, so the next change or restart tries again
+        print('ERROR: {}: {}'.format(album, e), file=sys.stderr)
+        state.record(album, FAILED, torrent_hash=torrent_hash, error=str(e))
+    finally:
+        watcher.finished(album)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--server', help="URL to Smuggler server")
+    parser.add_argument('--user', help="Smuggler user")
+    parser.add_argument('--password', help="Smuggler password")
+    parser.add_argument('--settle', type=float, default=30,
+                        help="Seconds an album must go unchanged before it "
+                             "is uploaded (default 30)")
+    parser.add_argument('--poll-interval', type=float, default=60,
+                        help="Seconds between rescans when inotify isn't "
+                             "available (default 60)")
+    parser.add_argument('--listen', metavar='HOST:PORT',
+                        help="Accept Transmission completion events here")
+    parser.add_argument('--notify', metavar='URL',
+                        help="Send the completion event for the torrent in "
+                             "Transmission's environment to URL and exit")
+    parser.add_argument('--state', default='smuggler-watch.db',
+                        help="State database (default smuggler-watch.db)")
+    parser.add_argument('--transmission-port', '-P', type=int,
+                        help="Find each album's torrent through Transmission "
+                             "RPC on this localhost port")
+    parser.add_argument('--transmission-user', '-u', help="Transmission user")
+    parser.add_argument('--transmission-password', '-p',
+                        help="Transmission password")
+    parser.add_argument('--upload-existing', action='store_true',
+                        help="On the first run, also upload albums already "
+                             "present whose torrent can't be found")
+    parser.add_argument('--workers', type=int, default=8,
+                        help="Files uploaded at the same time (default 8)")
+    parser.add_argument('--albums-at-once', type=int, default=2,
+                        help="Albums uploaded at the same time (default 2)")
+    parser.add_argument('--manifest', default='smuggler-manifest.jsonl',
+                        help="File recording completed uploads, for resuming")
+    parser.add_argument('directories', nargs='*',
+                        help="Download directories to watch")
+    args = parser.parse_args()
+
+    if args.notify:
+        notify(args.notify)
+        return
+    if not args.server or not args.directories:
+        parser.error("--server and at least one directory are required")
+
+    auth = (args.user, args.password) if args.user else None
+    uploader = Uploader(args.server, auth, workers=args.workers,
+                        manifest=args.manifest)
+    state = State(args.state)
+    watcher = Watcher(args.directories, state, args.settle)
+    transmission = None
+    if args.transmission_port:
+        transmission = Transmission(args.transmission_port,
+                                    args.transmission_user,
+                                    args.transmission_password)
+    seed(uploader, state, watcher, transmission, args.upload_existing)
+    if args.listen:
+        listen(args.listen, watcher)
+
+    if inotify_simple is not None:
+        source = InotifySource(watcher)
+    else:
+        print('inotify_simple is not installed; rescanning every {} '
+              'seconds'.format(args.poll_interval), file=sys.stderr)
+        source = PollingSource(watcher, args.poll_interval)
+
+    albums = ThreadPoolExecutor(max_workers=args.albums_at_once)
+    while True:
+        source.wait(1.0)
+        for album, metadata in watcher.due():
+            albums.submit(upload, uploader, state, watcher, transmission,
+                          album, metadata)
+
+
+if __name__ == "__main__":
+    main()
@@ -12,12 +12,20 @@ else:
     app.config.from_json(config_path, silent=True)
 
 os.makedirs(app.config['TEMP_DIR'], exist_ok=True)
+if not app.config['STATE_DB']:
+    app.config['STATE_DB'] = os.path.join(app.config['TEMP_DIR'], 'state.db')
+if not app.config['PROFILE_DIR']:
+    app.config['PROFILE_DIR'] = os.path.join(app.config['TEMP_DIR'],
+                                             'profiles')
 
 from smuggler.api import v1
+from smuggler import metrics, profiling, preload
 
 
 def init_app():
     app.register_blueprint(v1.bp, url_prefix='/api/v1')
+    if preload.wanted():
+        preload.preload()
 
 
 init_app()
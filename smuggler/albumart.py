@@ -0,0 +1,107 @@
+import importlib.util
+import os
+import tempfile
+import threading
+from smuggler import app
+from smuggler.metrics import stage
+
+_pool = None
+_pool_lock = threading.Lock()
+_warned = False
+
+
+class InvalidImage(ValueError):
+    pass
+
+
+def _get_pool():
+    global _pool
+    from concurrent.futures import ProcessPoolExecutor
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=app.config['ALBUMART_PROCESSES'])
+        return _pool
+
+
+def _reset_pool():
+    # A forked worker can't use its parent's pool processes
+    global _pool, _pool_lock
+    _pool = None
+    _pool_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_pool)
+
+
+def _render(path, sizes, quality, temp_dir):
+    """
+    Runs in a pool process. Checks that path is an image Pillow can decode,
+    then writes a JPEG no larger than each size in pixels on its longest
+    side, without the original's metadata. Returns [(size, path)].
+    """
+    from PIL import Image, ImageOps
+
+    try:
+        with Image.open(path) as image:
+            image.verify()
+        image = Image.open(path)
+        image.load()
+    except Exception as e:
+        raise InvalidImage("Album art is not a usable image: {}".format(e))
+
+    with image:
+        image = ImageOps.exif_transpose(image).convert('RGB')
+
+    rendered = []
+    try:
+        for size in sizes:
+            derivative = image.copy()
+            derivative.thumbnail((size, size), Image.LANCZOS)
+            f = tempfile.NamedTemporaryFile(dir=temp_dir, suffix='.jpg',
+                                            delete=False)
+            rendered.append((size, f.name))
+            with f:
+                derivative.save(f, 'JPEG', quality=quality, optimize=True,
+                                progressive=True)
+    except:
+        for _, name in rendered:
+            os.unlink(name)
+        raise
+    return rendered
+
+
+def preload():
+    """
+    Imports Pillow if derivatives are wanted, so that the pool processes
+    forked from this one start with it loaded.
+    """
+    if app.config['ALBUMART_DERIVATIVES'] and \
+            importlib.util.find_spec('PIL') is not None:
+        importlib.import_module('PIL.ImageOps')
+
+
+def make_derivatives(path):
+    """
+    Validates an album art image and renders the sizes in
+    ALBUMART_DERIVATIVES from it in the process pool, so decoding large
+    scans doesn't hold up this worker. Returns [(size, path)] of spooled
+    JPEGs that the caller must remove, or [] if derivatives are disabled or
+    Pillow isn't installed. Raises InvalidImage if the image is unusable.
+    """
+    global _warned
+    sizes = app.config['ALBUMART_DERIVATIVES']
+    if not sizes:
+        return []
+
+    if importlib.util.find_spec('PIL') is None:
+        if not _warned:
+            app.logger.warning("ALBUMART_DERIVATIVES is set but Pillow "
+                               "isn't installed; storing originals only")
+            _warned = True
+        return []
+
+    with stage('albumart_render'):
+        return _get_pool().submit(_render, path, sizes,
+                                  app.config['ALBUMART_QUALITY'],
+                                  app.config['TEMP_DIR']).result()
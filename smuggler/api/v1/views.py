@@ -1,16 +1,37 @@
 #!/usr/bin/env python3
 
-from flask import jsonify, request, abort
+from flask import jsonify, request, abort, url_for
 from smuggler.api.v1 import bp
 from smuggler import app
 from smuggler.auth import requires_auth
-from smuggler.tasks import moss_create_track, moss_lock_holding
-from smuggler.tasks import moss_create_albumart
-from smuggler.impala_session import ImpalaSession
-import tempfile
+from smuggler.impala_session import get_session, source_metadata
+from smuggler.ingest import ingest_track, ingest_archive
+from smuggler.ingest import store_albumart, InvalidArchive
+from smuggler.spool import spool_stream, requires_spool_space, has_room
+from smuggler.spool import insufficient_space, free_space
+from smuggler.spool import stats as spool_stats
+from smuggler import albumart, index, jobs, registration, uploads
+from smuggler.janitor import start_janitor
+from smuggler.upstream import UpstreamUnavailable, requires_upstreams
+from smuggler.limits import requires_fair_share
 import os
 
 
+@bp.before_app_request
+def start_background_threads():
+    start_janitor()
+    # Pick up jobs queued before a restart without waiting for a new upload
+    if app.config['ASYNC_INGEST']:
+        jobs.start_workers()
+
+
+def _accepted(job_id):
+    response = jsonify({'message': "accepted", 'job': job_id})
+    response.status_code = 202
+    response.headers['Location'] = url_for('.get_job', job_id=job_id)
+    return response
+
+
 @bp.route('/')
 def api_version_info():
     return jsonify({'stable': True})
@@ -19,43 +40,246 @@ def api_version_info():
 @bp.route('/holding_groups/<uuid:hgid>/<uuid:hid>/music/<path:path>',
           methods=['POST', 'PUT'])
 @requires_auth
+@requires_fair_share
+@requires_upstreams
+@requires_spool_space
 def upload_track(hgid, hid, path):
-    tempfile.tempdir = app.config['TEMP_DIR']
-    session = ImpalaSession(app.config['IMPALA_SERVER']['uri'],
-                            app.config['IMPALA_SERVER']['username'],
-                            app.config['IMPALA_SERVER']['password'])
-    f = tempfile.NamedTemporaryFile(delete=False, mode='wb')
-    tmpfname = f.name
-    f.write(request.data)
-    f.close()
+    spool = spool_stream(request.stream)
+
+    if app.config['ASYNC_INGEST']:
+        return _accepted(jobs.enqueue('track', hid, spool, hgid=hgid,
+                                      path=path))
 
     # These are intentionally synchronous so the client knows whether or not
     # their upload succeeded in both places. If it didn't, the client must
-    # rollback the changes made or overwrite them with the same UUID
+    # rollback the changes made or overwrite them with the same UUID. The two
+    # upstreams are independent, so they are updated in parallel.
     try:
-        moss_create_track(hid, tmpfname, path)
-        session.create_track(hgid, hid, tmpfname, path)
-        os.unlink(tmpfname)
+        deduplicated = ingest_track(hgid, hid, spool, path)
+    except UpstreamUnavailable:
+        raise
     except:
         abort(500)
+    finally:
+        os.unlink(spool.name)
+
+    return jsonify({'message': "ok", 'deduplicated': deduplicated})
+
+
+@bp.route('/holding_groups/<uuid:hgid>/<uuid:hid>/music/<path:path>',
+          methods=['HEAD'])
+@requires_auth
+def head_track(hgid, hid, path):
+    """
+    Tells a client whether a track is stored, with the SHA-256 of its
+    content as the ETag, so that it can skip sending the same file again.
+    """
+    stored = index.lookup(hid, path)
+    if stored is None:
+        abort(404)
+
+    response = app.response_class(status=200)
+    response.set_etag(stored[0])
+    return response
+
+
+@bp.route('/holdings/<uuid:hid>/manifest', methods=['POST'])
+@requires_auth
+def diff_manifest(hid):
+    """
+    Compares a client's list of a holding's files with what is stored.
+    Takes a JSON list of {"path", "size", "sha256"} objects and returns the
+    paths that are missing and those whose content differs; only these
+    need uploading. Relies on DEDUP_INDEX, without which everything is
+    reported missing.
+    """
+    entries = request.get_json(silent=True)
+    if not isinstance(entries, list) or \
+            len(entries) > app.config['MANIFEST_MAX_ENTRIES']:
+        abort(400)
+
+    stored = index.holding_contents(hid)
+    missing = []
+    changed = []
+    for entry in entries:
+        if not isinstance(entry, dict):
+            abort(400)
+        path = entry.get('path')
+        sha256 = entry.get('sha256')
+        size = entry.get('size')
+        if not isinstance(path, str) or not isinstance(sha256, str) or \
+                not isinstance(size, int) or isinstance(size, bool):
+            abort(400)
+        content = (sha256.lower(), size)
+
+        if path not in stored:
+            missing.append(path)
+        elif stored[path] != content:
+            changed.append(path)
+
+    return jsonify({'missing': missing, 'changed': changed})
+
 
+def _upload_status(session, status_code=200):
+    response = jsonify({'upload': session['id'],
+                        'offset': session['offset'],
+                        'length': session['length']})
+    response.status_code = status_code
+    response.headers['Upload-Offset'] = str(session['offset'])
+    response.headers['Upload-Length'] = str(session['length'])
+    response.headers['Location'] = url_for('.get_upload',
+                                           upload_id=session['id'])
+    return response
+
+
+@bp.route('/holding_groups/<uuid:hgid>/<uuid:hid>/uploads/<path:path>',
+          methods=['POST'])
+@requires_auth
+def create_upload(hgid, hid, path):
+    """
+    Starts a resumable upload of a track. The client gives the full size in
+    Upload-Length, then PATCHes the returned upload with consecutive byte
+    ranges, each starting at the Upload-Offset it was last told.
+    """
+    length = request.headers.get('Upload-Length', type=int)
+    if length is None or length < 0:
+        abort(400)
+    if not has_room(length):
+        return insufficient_space()
+
+    session = uploads.create_session(hgid, hid, path, length)
+    return _upload_status(session, 201)
+
+
+@bp.route('/uploads/<upload_id>', methods=['GET'])
+@requires_auth
+def get_upload(upload_id):
+    session = uploads.get_session(upload_id)
+    if session is None:
+        abort(404)
+    return _upload_status(session)
+
+
+@bp.route('/uploads/<upload_id>', methods=['DELETE'])
+@requires_auth
+def delete_upload(upload_id):
+    uploads.delete_session(upload_id)
     return jsonify({'message': "ok"})
 
 
+@bp.route('/uploads/<upload_id>', methods=['PATCH'])
+@requires_auth
+@requires_fair_share
+@requires_upstreams
+@requires_spool_space
+def patch_upload(upload_id):
+    offset = request.headers.get('Upload-Offset', type=int)
+    if offset is None:
+        abort(400)
+
+    try:
+        session = uploads.append_chunk(upload_id, offset, request.stream)
+    except uploads.UploadConflict as e:
+        response = jsonify({'message': str(e), 'offset': e.offset})
+        response.status_code = 409
+        response.headers['Upload-Offset'] = str(e.offset)
+        return response
+
+    if session is None:
+        abort(404)
+    if session['offset'] < session['length']:
+        return _upload_status(session)
+
+    # The last chunk has arrived, so ingest it as if it had been PUT whole
+    spool = uploads.complete_spool(session)
+
+    if app.config['ASYNC_INGEST']:
+        job_id = jobs.enqueue('track', session['hid'], spool,
+                              hgid=session['hgid'], path=session['path'])
+        uploads.release_session(upload_id)
+        return _accepted(job_id)
+
+    try:
+        deduplicated = ingest_track(session['hgid'], session['hid'], spool,
+                                    session['path'])
+    except Exception as e:
+        # Keep the staged file; PATCHing again at the final offset retries
+        uploads.unlock(upload_id)
+        if isinstance(e, UpstreamUnavailable):
+            raise
+        abort(500)
+
+    uploads.delete_session(upload_id)
+    return jsonify({'message': "ok", 'deduplicated': deduplicated})
+
+
+@bp.route('/holding_groups/<uuid:hgid>/<uuid:hid>/archive',
+          methods=['POST', 'PUT'])
+@requires_auth
+@requires_fair_share
+@requires_upstreams
+@requires_spool_space
+def upload_archive(hgid, hid):
+    """
+    Imports a whole holding from a single tar (optionally compressed) or zip
+    archive. Source metadata may be passed in the query string, and the
+    holding is locked afterwards unless lock=0 is given.
+    """
+    # Checked before the body is read, so that bad metadata doesn't leave
+    # behind an imported holding that was never locked
+    try:
+        source = source_metadata(request.args)
+    except ValueError:
+        abort(400)
+
+    try:
+        paths = ingest_archive(hgid, hid, request.stream)
+    except InvalidArchive:
+        abort(400)
+    except UpstreamUnavailable:
+        raise
+    except:
+        app.logger.exception("Failed to ingest archive for %s", hid)
+        abort(500)
+
+    if source:
+        try:
+            get_session().set_source_metadata(hid, source)
+        except ValueError:
+            abort(400)
+
+    if request.args.get('lock', '1') != '0':
+        try:
+            registration.lock_holding(hid)
+        except registration.HoldingGroupConflict as e:
+            response = jsonify({'message': str(e)})
+            response.status_code = 409
+            return response
+
+    return jsonify({'message': "ok", 'files': paths})
+
+
 @bp.route('/holdings/<uuid:hid>/albumart', methods=['POST', 'PUT'])
 @requires_auth
+@requires_fair_share
+@requires_upstreams
+@requires_spool_space
 def upload_albumart(hid):
-    tempfile.tempdir = app.config['TEMP_DIR']
-    f = tempfile.NamedTemporaryFile(delete=False, mode='wb')
-    tmpfname = f.name
-    f.write(request.data)
-    f.close()
+    spool = spool_stream(request.stream)
+
+    if app.config['ASYNC_INGEST']:
+        return _accepted(jobs.enqueue('albumart', hid, spool))
 
     try:
-        moss_create_albumart(hid, tmpfname)
-        os.unlink(tmpfname)
+        store_albumart(hid, spool.name)
+    except albumart.InvalidImage:
+        abort(400)
+    except UpstreamUnavailable:
+        raise
     except:
         abort(500)
+    finally:
+        os.unlink(spool.name)
 
     return jsonify({'message': "ok"})
 
@@ -63,17 +287,33 @@ def upload_albumart(hid):
 @bp.route('/holdings/<uuid:hid>/lock', methods=['POST', 'PUT'])
 @requires_auth
 def lock_holding(hid):
-    moss_lock_holding(hid)
+    # Don't lock the holding while its uploads are still being processed
+    if app.config['ASYNC_INGEST']:
+        summary = jobs.wait_for_holding(hid, app.config['JOB_LOCK_TIMEOUT'])
+        if not summary['complete'] or summary['counts'][jobs.FAILED] > 0:
+            response = jsonify({'message': "holding has unfinished or "
+                                           "failed jobs",
+                                'jobs': summary})
+            response.status_code = 409
+            return response
+
+    try:
+        registration.lock_holding(hid)
+    except registration.HoldingGroupConflict as e:
+        response = jsonify({'message': str(e)})
+        response.status_code = 409
+        return response
     return jsonify({'message': "ok"})
 
 
 @bp.route('/holdings/<uuid:hid>/source', methods=['POST'])
 @requires_auth
 def set_holding_torrent_hash(hid):
-    session = ImpalaSession(app.config['IMPALA_SERVER']['uri'],
-                            app.config['IMPALA_SERVER']['username'],
-                            app.config['IMPALA_SERVER']['password'])
-    session.set_source_metadata(hid, request.form)
+    session = get_session()
+    try:
+        session.set_source_metadata(hid, request.form)
+    except ValueError:
+        abort(400)
 
     return jsonify({'message': 'ok'})
 
@@ -82,9 +322,7 @@ def set_holding_torrent_hash(hid):
 @requires_auth
 def get_torrent(infohash):
     infohash = infohash.lower()
-    session = ImpalaSession(app.config['IMPALA_SERVER']['uri'],
-                            app.config['IMPALA_SERVER']['username'],
-                            app.config['IMPALA_SERVER']['password'])
+    session = get_session()
 
     result = session.get_holding_from_torrent(infohash)
 
@@ -92,3 +330,56 @@ def get_torrent(infohash):
         return jsonify({'holding': result})
     else:
         abort(404)
+
+
+@bp.route('/torrents/lookup', methods=['POST'])
+@requires_auth
+def lookup_torrents():
+    """
+    Looks up many torrents at once. Takes a JSON list of infohashes, or an
+    object with the list under 'infohashes', and returns the holding for
+    each one, or null if no holding has it.
+    """
+    body = request.get_json(silent=True)
+    if isinstance(body, dict):
+        body = body.get('infohashes')
+    if not isinstance(body, list) or \
+            len(body) > app.config['TORRENT_LOOKUP_MAX']:
+        abort(400)
+
+    infohashes = []
+    for infohash in body:
+        if not isinstance(infohash, str) or not infohash.isalnum():
+            abort(400)
+        infohashes.append(infohash.lower())
+
+    session = get_session()
+    holdings = session.get_holdings_from_torrents(infohashes)
+    return jsonify({'results': dict(zip(infohashes, holdings))})
+
+
+@bp.route('/jobs/<job_id>', methods=['GET'])
+@requires_auth
+def get_job(job_id):
+    job = jobs.get_job(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job)
+
+
+@bp.route('/holdings/<uuid:hid>/jobs', methods=['GET'])
+@requires_auth
+def get_holding_jobs(hid):
+    return jsonify(jobs.holding_jobs(hid))
+
+
+@bp.route('/spool', methods=['GET'])
+@requires_auth
+def get_spool_stats():
+    """
+    Reports this worker's admission control and janitor counters.
+    """
+    stats = dict(spool_stats)
+    stats['free_bytes'] = free_space()
+    stats['min_free_bytes'] = app.config['MIN_FREE_SPACE']
+    return jsonify(stats)
@@ -0,0 +1,341 @@
+"""
+An asyncio serving mode for smuggler, for use with an ASGI server such as
+uvicorn:
+
+    uvicorn smuggler.asgi:application
+
+Track and album art upload bodies are received here without tying up a
+thread, however slowly they arrive, and spooled to disk. Once spooled they
+are ingested by the same functions as in the WSGI app, on a pool of
+ASGI_INGEST_THREADS threads with their moss transfers on a second pool of
+that size; state database calls run on a small pool of their own. Every
+other route is passed through to the usual Flask app, with at most
+ASGI_WSGI_THREADS requests at a time. The WSGI app in smuggler.app is
+unaffected and remains the default.
+"""
+import asyncio
+import base64
+import binascii
+import hashlib
+import json
+import os
+import re
+import tempfile
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import ThreadSensitiveContext
+from asgiref.wsgi import WsgiToAsgi
+
+from smuggler import albumart, app, jobs, upstream
+from smuggler.auth import check_auth
+from smuggler.ingest import ingest_track, store_albumart
+from smuggler.janitor import start_janitor
+from smuggler.limits import OverBudget, SlotRequest, release_slot
+from smuggler.metrics import stage, UPLOADS_IN_FLIGHT
+from smuggler.spool import SpoolFile, reserve_space, release_space
+from smuggler.upstream import UpstreamUnavailable
+
+_UUID = r'[0-9a-fA-F]{8}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?' \
+        r'[0-9a-fA-F]{4}-?[0-9a-fA-F]{12}'
+_TRACK_RE = re.compile(r'^/api/v1/holding_groups/(?P<hgid>{0})/(?P<hid>{0})'
+                       r'/music/(?P<path>.+)$'.format(_UUID))
+_ALBUMART_RE = re.compile(r'^/api/v1/holdings/(?P<hid>{})/albumart$'
+                          .format(_UUID))
+
+_pools = {}
+_wsgi = WsgiToAsgi(app)
+_wsgi_slots = None
+
+
+def _pool(name, size):
+    """
+    Returns this process's thread pool of the given name, creating it with
+    size threads on first use.
+    """
+    if name not in _pools:
+        _pools[name] = ThreadPoolExecutor(
+            max_workers=size, thread_name_prefix='smuggler-' + name)
+    return _pools[name]
+
+
+def _state(f, *args):
+    """
+    Runs a short state database call, such as polling for an upload slot,
+    on a pool of its own so that it never queues behind ingest. Returns an
+    awaitable for it.
+    """
+    pool = _pool('state', app.config['ASGI_STATE_THREADS'])
+    return asyncio.get_event_loop().run_in_executor(pool, f, *args)
+
+
+def _ingest(f, *args):
+    """
+    Runs one of smuggler.ingest's functions, with its moss transfers on a
+    pool of their own rather than the worker pool the WSGI app sizes for
+    one request at a time. Returns an awaitable for it.
+    """
+    size = app.config['ASGI_INGEST_THREADS']
+    return asyncio.get_event_loop().run_in_executor(
+        _pool('ingest', size), f, *args, _pool('moss', size))
+
+
+async def _passthrough(scope, receive, send):
+    """
+    Passes a request through to the Flask app. asgiref runs the app on one
+    thread per process unless given a context of its own, which would make
+    a request waiting to lock a holding hold up all the others; each
+    request gets one here, limited to ASGI_WSGI_THREADS at once.
+    """
+    global _wsgi_slots
+    if _wsgi_slots is None:
+        _wsgi_slots = asyncio.Semaphore(app.config['ASGI_WSGI_THREADS'])
+    async with _wsgi_slots:
+        async with ThreadSensitiveContext():
+            await _wsgi(scope, receive, send)
+
+
+async def _respond(send, status, body, headers=None):
+    if isinstance(body, (dict, list)):
+        data = json.dumps(body).encode()
+        content_type = b'application/json'
+    else:
+        data = body.encode()
+        content_type = b'text/plain; charset=utf-8'
+
+    raw_headers = [(b'content-type', content_type),
+                   (b'content-length', str(len(data)).encode())]
+    for key, value in (headers or {}).items():
+        raw_headers.append((key.lower().encode(), str(value).encode()))
+
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': raw_headers})
+    await send({'type': 'http.response.body', 'body': data})
+
+
+def _headers(scope):
+    return {key.decode('latin-1').lower(): value.decode('latin-1')
+            for key, value in scope['headers']}
+
+
+def _authorized_user(headers):
+    """
+    Returns the user named by valid basic auth credentials, or None.
+    """
+    scheme, _, credentials = headers.get('authorization', '').partition(' ')
+    if scheme.lower() != 'basic':
+        return None
+    try:
+        decoded = base64.b64decode(credentials).decode()
+    except (binascii.Error, UnicodeDecodeError):
+        return None
+    username, _, password = decoded.partition(':')
+    return username if check_auth(username, password) else None
+
+
+async def _wait_for_slot(user):
+    """
+    Waits for an upload slot like smuggler.limits.wait_for_slot, but
+    sleeping on the event loop. Returns the slot's ID.
+    """
+    slot = await _state(SlotRequest, user)
+    try:
+        while not await _state(slot.poll):
+            await asyncio.sleep(app.config['FAIR_QUEUE_POLL_INTERVAL'])
+    except asyncio.CancelledError:
+        await _state(release_slot, slot.id)
+        raise
+    return slot.id
+
+
+async def spool_body(receive):
+    """
+    Writes a request body to a new temporary file in TEMP_DIR as it
+    arrives, hashing it as it goes. Disk writes are made off the event loop
+    once SPOOL_CHUNK_SIZE bytes have been buffered. Returns a SpoolFile;
+    the caller owns the file.
+    """
+    loop = asyncio.get_event_loop()
+    chunk_size = app.config['SPOOL_CHUNK_SIZE']
+    checksum = hashlib.sha256()
+    size = 0
+    buffered = bytearray()
+
+    def flush(data):
+        f.write(data)
+        checksum.update(data)
+
+    f = tempfile.NamedTemporaryFile(dir=app.config['TEMP_DIR'], delete=False,
+                                    mode='wb')
+    try:
+        with stage('spool'), f:
+            more_body = True
+            while more_body:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    raise IOError("Client disconnected during upload")
+                buffered += message.get('body', b'')
+                more_body = message.get('more_body', False)
+
+                if len(buffered) >= chunk_size or not more_body:
+                    data, buffered = bytes(buffered), bytearray()
+                    await loop.run_in_executor(None, flush, data)
+                    size += len(data)
+    except BaseException:
+        os.unlink(f.name)
+        raise
+
+    return SpoolFile(f.name, size, checksum.hexdigest())
+
+
+async def _accepted(send, kind, hid, spool, hgid=None, path=None):
+    job_id = await _state(jobs.enqueue, kind, hid, spool, hgid, path)
+    await _respond(send, 202, {'message': "accepted", 'job': job_id},
+                   {'Location': '/api/v1/jobs/' + job_id})
+
+
+async def _failed(send, e):
+    if isinstance(e, UpstreamUnavailable):
+        await _respond(send, 503, str(e) + '\n',
+                       {'Retry-After': e.retry_after})
+    else:
+        await _respond(send, 500, "Internal Server Error\n")
+
+
+async def upload_track(receive, send, hgid, hid, path):
+    spool = await spool_body(receive)
+
+    if app.config['ASYNC_INGEST']:
+        await _accepted(send, 'track', hid, spool, hgid, path)
+        return
+
+    try:
+        deduplicated = await _ingest(ingest_track, hgid, hid, spool, path)
+    except Exception as e:
+        app.logger.exception("Failed to ingest %s for %s", path, hid)
+        await _failed(send, e)
+        return
+    finally:
+        os.unlink(spool.name)
+
+    await _respond(send, 200, {'message': "ok", 'deduplicated': deduplicated})
+
+
+async def upload_albumart(receive, send, hid):
+    spool = await spool_body(receive)
+
+    if app.config['ASYNC_INGEST']:
+        await _accepted(send, 'albumart', hid, spool)
+        return
+
+    try:
+        await _ingest(store_albumart, hid, spool.name)
+    except albumart.InvalidImage as e:
+        await _respond(send, 400, str(e) + '\n')
+        return
+    except Exception as e:
+        app.logger.exception("Failed to store album art for %s", hid)
+        await _failed(send, e)
+        return
+    finally:
+        os.unlink(spool.name)
+
+    await _respond(send, 200, {'message': "ok"})
+
+
+def _route(scope):
+    """
+    Returns the coroutine function and arguments for an upload we handle
+    natively, or None if the request should go to the Flask app.
+    """
+    if scope['method'] not in ('PUT', 'POST'):
+        return None
+
+    match = _TRACK_RE.match(scope['path'])
+    if match:
+        return upload_track, (uuid.UUID(match.group('hgid')),
+                              uuid.UUID(match.group('hid')),
+                              match.group('path'))
+    match = _ALBUMART_RE.match(scope['path'])
+    if match:
+        return upload_albumart, (uuid.UUID(match.group('hid')),)
+    return None
+
+
+def _start_background_threads():
+    start_janitor()
+    if app.config['ASYNC_INGEST']:
+        jobs.start_workers()
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            _start_background_threads()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def _admitted(route, receive, send, headers):
+    if not app.config['ASYNC_INGEST']:
+        try:
+            upstream.check_available()
+        except UpstreamUnavailable as e:
+            await _failed(send, e)
+            return
+
+    reservation = await _state(reserve_space,
+                               int(headers.get('content-length') or 0))
+    if reservation is None:
+        await _respond(send, 503,
+                       'Not enough spool space to accept this upload right '
+                       'now.\n',
+                       {'Retry-After': app.config['SPOOL_RETRY_AFTER']})
+        return
+
+    view, args = route
+    UPLOADS_IN_FLIGHT.inc()
+    try:
+        await view(receive, send, *args)
+    finally:
+        UPLOADS_IN_FLIGHT.dec()
+        await _state(release_space, reservation)
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+
+    route = _route(scope) if scope['type'] == 'http' else None
+    if route is None:
+        await _passthrough(scope, receive, send)
+        return
+
+    headers = _headers(scope)
+    user = _authorized_user(headers)
+    if user is None:
+        await _respond(send, 401,
+                       'Could not verify your access level for that URL.\n'
+                       'You have to login with proper credentials',
+                       {'WWW-Authenticate': 'Basic realm="Login Required"'})
+        return
+
+    _start_background_threads()
+
+    # The same checks as requires_fair_share, requires_upstreams and
+    # requires_spool_space
+    try:
+        slot_id = await _wait_for_slot(user)
+    except OverBudget as e:
+        await _respond(send, 429, str(e) + '\n',
+                       {'Retry-After': e.retry_after})
+        return
+
+    try:
+        await _admitted(route, receive, send, headers)
+    finally:
+        await _state(release_slot, slot_id)
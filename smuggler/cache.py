@@ -0,0 +1,69 @@
+import threading
+from collections import OrderedDict
+
+
+class ExistenceCache:
+    """
+    A bounded, thread-safe record of remote objects we know to exist, with
+    least-recently-used eviction. ensure() also acts as a singleflight guard
+    so that concurrent callers only create a given object once.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return True
+            return False
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, key):
+        with self._lock:
+            self._entries[key] = True
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def ensure(self, key, create):
+        """
+        Calls create() unless key is already known to exist. If another
+        thread is creating the same key we wait for it instead; should it
+        fail, one of the waiters tries again. Exceptions from create() are
+        passed on and nothing is cached.
+        """
+        while True:
+            with self._lock:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    return
+
+                event = self._inflight.get(key)
+                if event is None:
+                    event = self._inflight[key] = threading.Event()
+                    break
+
+            event.wait()
+
+        try:
+            create()
+            self.add(key)
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            event.set()
+
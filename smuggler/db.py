@@ -0,0 +1,108 @@
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from smuggler import app
+
+_local = threading.local()
+_schemas = []
+
+_process = None
+_process_lock = threading.Lock()
+
+
+def register_schema(schema):
+    """
+    Adds SQL statements to run, idempotently, whenever a new connection to
+    the state database is opened. Modules call this at import time.
+    """
+    _schemas.append(schema)
+
+
+def get_db():
+    """
+    Returns this thread's connection to the state database in STATE_DB. The
+    connection is in autocommit mode; use BEGIN IMMEDIATE for transactions
+    that must not interleave with other workers.
+    """
+    pid = os.getpid()
+    conn = getattr(_local, 'conn', None)
+    # A connection inherited across fork() must never be used
+    if conn is None or _local.pid != pid:
+        conn = sqlite3.connect(app.config['STATE_DB'], timeout=30,
+                               isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        for schema in _schemas:
+            conn.executescript(schema)
+        _local.conn = conn
+        _local.pid = pid
+    return conn
+
+
+# Leases of the processes using the state database. Rows that other tables
+# say a process owns are identified by its lease ID, which unlike a PID is
+# never reused, and are taken back once its heartbeat stops.
+register_schema("""
+CREATE TABLE IF NOT EXISTS processes (
+    id TEXT PRIMARY KEY,
+    pid INTEGER NOT NULL,
+    heartbeat REAL NOT NULL
+);
+""")
+
+
+def _heartbeat(lease, started):
+    while True:
+        try:
+            # Replaces the lease if another process expired it meanwhile
+            get_db().execute('INSERT OR REPLACE INTO processes '
+                             '(id, pid, heartbeat) VALUES (?, ?, ?)',
+                             (lease, os.getpid(), time.time()))
+        except Exception:
+            app.logger.exception("Failed to renew this process's lease")
+        started.set()
+        time.sleep(app.config['PROCESS_HEARTBEAT_INTERVAL'])
+
+
+def process_id():
+    """
+    Returns the ID of this process's lease, taking one out and starting the
+    thread that keeps it alive on first use in each process. The lease is
+    written on that thread's own connection, so call this before opening a
+    transaction that will refer to it.
+    """
+    global _process
+    pid = os.getpid()
+    with _process_lock:
+        # A lease inherited across fork() belongs to the parent
+        if _process is not None and _process[0] == pid:
+            return _process[1]
+
+        lease = str(uuid.uuid4())
+        started = threading.Event()
+        threading.Thread(target=_heartbeat, args=(lease, started),
+                         name='smuggler-heartbeat', daemon=True).start()
+        started.wait()
+        _process = (pid, lease)
+        return lease
+
+
+def _reset_process():
+    global _process_lock
+    _process_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_process)
+
+
+def expire_processes(db):
+    """
+    Deletes the leases of processes that have stopped renewing them, so
+    that anything still owned by them can be found with
+    "owner NOT IN (SELECT id FROM processes)".
+    """
+    db.execute('DELETE FROM processes WHERE heartbeat < ?',
+               (time.time() - app.config['PROCESS_LEASE_TTL'],))
+
@@ -1,76 +1,161 @@
+import os
 import requests
-from beets.library import Item
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 from urllib.parse import urljoin, urlparse
-from smuggler import app
+from smuggler import app, torrents, upstream
+from smuggler.cache import ExistenceCache
+from smuggler.metadata import read_metadata, TrackMetadata
+from smuggler.metrics import stage, impala_endpoint, IMPALA_REQUESTS
+
+
+def source_metadata(metadata):
+    """
+    Returns the source metadata fields of metadata that impala accepts,
+    normalized, or raises ValueError if any of them is invalid.
+    """
+    data = {}
+    for key in ['torrent_hash', 'source_url', 'source_desc']:
+        if key in metadata:
+            data[key] = metadata[key]
+
+    if 'torrent_hash' in data:
+        data['torrent_hash'] = data['torrent_hash'].lower()
+
+    if 'source_url' in data:
+        if urlparse(data['source_url']).scheme not in ['http', 'https']:
+            raise ValueError('source_url scheme must be http(s)')
+        if not urlparse(data['source_url']).netloc:
+            raise ValueError('source_url must have netloc set')
+
+    return data
+
+
+class BulkUnsupported(Exception):
+    """
+    Raised when impala rejects a list of metadata rows in a way that
+    suggests it doesn't take lists at all.
+    """
 
 
 class ImpalaSession:
-    def __init__(self, uri, username, password):
+    """
+    A logged-in connection to impala. Requests share a connection pool and
+    the session cookie; we only log in again when impala tells us the cookie
+    is no longer valid. Safe to share between threads.
+
+    Formats, stacks, holding groups and holdings that we have already seen
+    in impala are remembered in self.known so that later tracks of the same
+    album don't have to PUT them again. Torrent lookups are cached in the
+    state database, shared with the other workers, for torrent_ttl seconds,
+    or negative_ttl if no holding had the torrent.
+    """
+    def __init__(self, uri, username, password, pool_size=10,
+                 cache_size=1024, bulk_metadata=False, metadata_concurrency=8,
+                 torrent_ttl=3600, negative_ttl=60, lookup_concurrency=4):
         self.uri = uri
         self.username = username
         self.password = password
         self.session = None
-        self.login()
-
-    def login(self):
-        endpoint = urljoin(self.uri, 'api/v1/login')
-        r = requests.get(endpoint,
-                         auth=HTTPBasicAuth(self.username, self.password))
-        if r.status_code < 200 or r.status_code >= 300:
-            raise IOError(str(r.status_code) + ": Login to impala failed")
-
-        self.session = r.cookies['session']
+        self.known = ExistenceCache(cache_size)
+        self.torrent_ttl = torrent_ttl
+        self.negative_ttl = negative_ttl
+        self.bulk_metadata = bulk_metadata
+        self._login_lock = threading.Lock()
+        self._metadata_pool = ThreadPoolExecutor(
+            max_workers=metadata_concurrency)
+        self._lookup_pool = ThreadPoolExecutor(
+            max_workers=lookup_concurrency)
+
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.http.mount('http://', adapter)
+        self.http.mount('https://', adapter)
+
+    def login(self, stale=None, timeout=None):
+        """
+        Logs in to impala and returns the new session cookie. If stale is
+        given and another thread has already replaced that cookie, the
+        current one is returned instead of logging in again.
+        """
+        if timeout is None:
+            timeout = app.config['UPSTREAM_TIMEOUT']
+        with self._login_lock:
+            if self.session is not None and self.session != stale:
+                return self.session
+
+            endpoint = urljoin(self.uri, 'api/v1/login')
+            r = self.http.get(endpoint,
+                              auth=HTTPBasicAuth(self.username, self.password),
+                              timeout=timeout)
+            if r.status_code < 200 or r.status_code >= 300:
+                raise IOError(str(r.status_code) + ": Login to impala failed")
+
+            self.session = r.cookies['session']
+            return self.session
 
     def logout(self):
         endpoint = urljoin(self.uri, 'api/v1/logout')
-        r = requests.get(endpoint,
-                         cookies={'session': self.session})
+        r = self.http.get(endpoint,
+                          cookies={'session': self.session})
         self.session = None
         if r.status_code < 200 or r.status_code >= 300:
             raise IOError(str(r.status_code) + ": Failed to logout of impala")
 
-    def get(self, endpoint):
+    def _request(self, method, endpoint, **kwargs):
+        label = impala_endpoint(endpoint)
         endpoint = urljoin(self.uri, endpoint)
-        if not self.session:
-            self.login()
-        return requests.get(endpoint, cookies={'session': self.session})
+
+        def send(timeout):
+            session = self.session or self.login(timeout=timeout)
+            r = self.http.request(method, endpoint, timeout=timeout,
+                                  cookies={'session': session}, **kwargs)
+            IMPALA_REQUESTS.labels(method, label, r.status_code).inc()
+
+            # Our cookie has expired or been revoked; log in again and
+            # retry once
+            if r.status_code == 401:
+                session = self.login(stale=session, timeout=timeout)
+                r = self.http.request(method, endpoint, timeout=timeout,
+                                      cookies={'session': session}, **kwargs)
+                IMPALA_REQUESTS.labels(method, label, r.status_code).inc()
+            return r
+
+        # impala answers a repeated PUT with a 409, so any call may be retried
+        return upstream.impala.call(send)
+
+    def get(self, endpoint):
+        return self._request('GET', endpoint)
 
     def put(self, endpoint, resource):
-        endpoint = urljoin(self.uri, endpoint)
-        if not self.session:
-            self.login()
-        return requests.put(endpoint, data=resource,
-                            cookies={'session': self.session})
+        return self._request('PUT', endpoint, data=resource)
+
+    def put_json(self, endpoint, resource):
+        return self._request('PUT', endpoint, json=resource)
 
     def patch(self, endpoint, data):
-        endpoint = urljoin(self.uri, endpoint)
-        if not self.session:
-            self.login()
-        return requests.patch(endpoint, data=data,
-                              cookies={'session': self.session})
+        return self._request('PATCH', endpoint, data=data)
+
+    def delete(self, endpoint):
+        return self._request('DELETE', endpoint)
 
     def set_source_metadata(self, hid, metadata):
         """
         Sets the source metadata for a Holding. Only three fields may be
         modified: torrent_hash, source_url, and source_desc.
         """
-        data = {}
+        data = source_metadata(metadata)
         hid = str(hid)
-        for key in ['torrent_hash', 'source_url', 'source_desc']:
-            if key in metadata:
-                data[key] = metadata[key]
 
-        if 'torrent_hash' in data:
-            data['torrent_hash'] = data['torrent_hash'].lower()
+        r = self.patch('api/v1/holdings/' + hid, data=data)
 
-        if 'source_url' in data:
-            if urlparse(data['source_url']).scheme not in ['http', 'https']:
-                raise ValueError('source_url scheme must be http(s)')
-            if not urlparse(data['source_url']).netloc:
-                raise ValueError('source_url must have netloc set')
+        if 'torrent_hash' in data:
+            # Both the holding's old torrent and the new one have changed
+            torrents.forget(data['torrent_hash'], hid)
 
-        r = self.patch('api/v1/holdings/' + hid, data=data)
         if r.status_code < 200 or r.status_code >= 300:
             raise IOError(str(r.status_code) + ": Failed to set src metadata")
 
@@ -82,37 +167,146 @@ class ImpalaSession:
             raise ValueError("infohash must be alphanumeric")
         infohash = infohash.lower()
 
+        cached, hid = torrents.lookup(infohash)
+        if cached:
+            return hid
+
         r = self.get('api/v1/holdings/search?torrent_hash=' + infohash)
         results = r.json()['results']
         if not results:
-            return None
+            hid = None
         else:
-            return results[0]['id']
+            hid = results[0]['id']
+
+        ttl = self.torrent_ttl if hid is not None else self.negative_ttl
+        torrents.record(infohash, hid, ttl)
+        return hid
+
+    def get_holdings_from_torrents(self, infohashes):
+        """
+        Returns the holding UUID, or None, for each of infohashes in order.
+        Lookups run in parallel on a pool of their own, so a large batch
+        doesn't hold up ingest's transfers.
+        """
+        return list(self._lookup_pool.map(self.get_holding_from_torrent,
+                                          infohashes))
 
     def create_track(self, hgid, hid, tmpfname, path):
         """
         Creates the data corresponding to the track in impala associated with
-        the holding uuid based on metadata gleaned from beets. If it fails,
+        the holding uuid based on metadata read from its tags. If it fails,
         raises an exception.
         """
-        try:
-            # In the event the item isn't a music track, we need to prevent it
-            # from getting added to impala but keep it in moss.
-            i = Item.from_path(tmpfname)
-        except:
+        # In the event the item isn't a music track, we need to prevent it
+        # from getting added to impala but keep it in moss.
+        with stage('tag_parse'):
+            i = read_metadata(tmpfname)
+        if i is None:
             return
 
+        with stage('impala_register'):
+            self._register_track(hgid, hid, path, i)
+
+    def _register_track(self, hgid, hid, path, i):
+        default_uuids = app.config['DEFAULT_UUIDS']
+        hgid = str(hgid)
+        hid = str(hid)
+
         # Create a stack and format if they don't already exist
-        self._create_default_objects()
+        self.known.ensure(('defaults', default_uuids['format'],
+                           default_uuids['stack']),
+                          self._create_default_objects)
 
         # Create the holding group if it doesn't already exist
-        self._create_holding_group(hgid, i)
+        self.known.ensure(('holding_group', hgid),
+                          lambda: self._create_holding_group(hgid, i))
 
         # Create the holding if it doesn't already exist
-        self._create_holding(hgid, hid, i)
+        self.known.ensure(('holding', hid),
+                          lambda: self._create_holding(hgid, hid, i))
 
         # Create the track
-        self._create_track(hid, path, i)
+        self._create_track(hgid, hid, path, i)
+
+    def register_holding(self, hgid, hid, tracks):
+        """
+        Registers a whole holding at once from its tracks, a list of
+        (path, TrackMetadata) pairs. The holding group and holding are made
+        from the album-level tags most of the tracks agree on, then the
+        tracks are created in disc and track order and all of their
+        metadata is sent together.
+
+        If any of it fails, whatever this call created is deleted again
+        before the exception is raised. Otherwise returns the endpoints of
+        the new objects, for rollback() should a later step fail.
+        """
+        hgid = str(hgid)
+        hid = str(hid)
+        tracks = sorted(tracks, key=lambda t: (_number(t[1].disc),
+                                               _number(t[1].track), t[0]))
+        album = _album_metadata([item for _, item in tracks])
+        default_uuids = app.config['DEFAULT_UUIDS']
+        created = []
+
+        try:
+            self.known.ensure(('defaults', default_uuids['format'],
+                               default_uuids['stack']),
+                              self._create_default_objects)
+            if self._create_holding_group(hgid, album):
+                created.append('api/v1/holding_groups/' + hgid)
+            if self._create_holding(hgid, hid, album):
+                created.append('api/v1/holdings/' + hid)
+
+            futures = [self._metadata_pool.submit(self._put_track, hgid, hid,
+                                                  path, item)
+                       for path, item in tracks]
+            # Collect every result first so no new track escapes rollback
+            rows = []
+            error = None
+            for (path, item), future in zip(tracks, futures):
+                try:
+                    track_id, new = future.result()
+                except Exception as e:
+                    error = error or e
+                    continue
+                if new:
+                    created.append('api/v1/tracks/' + track_id)
+                rows.extend(self._metadata_rows(track_id, item))
+            if error is not None:
+                raise error
+
+            self._put_metadata_rows(rows)
+        except:
+            self.rollback(created)
+            self.forget_holding(hid, hgid)
+            raise
+
+        self.known.add(('holding_group', hgid))
+        self.known.add(('holding', hid))
+        return created
+
+    def rollback(self, created):
+        """
+        Deletes objects created by register_holding(), newest first.
+        Metadata rows go with their track. Failures are only logged, since
+        the error that made us roll back is the one worth reporting.
+        """
+        for endpoint in reversed(created):
+            try:
+                r = self.delete(endpoint)
+                if r.status_code not in [200, 204, 404]:
+                    raise IOError("Got {} from impala".format(r.status_code))
+            except Exception:
+                app.logger.exception("Failed to roll back %s", endpoint)
+
+    def forget_holding(self, hid, hgid=None):
+        """
+        Drops a holding, and optionally its holding group, from the cache of
+        known objects so that the next track will create them again.
+        """
+        self.known.invalidate(('holding', str(hid)))
+        if hgid is not None:
+            self.known.invalidate(('holding_group', str(hgid)))
 
     def _create_default_objects(self):
         """
@@ -158,6 +352,7 @@ class ImpalaSession:
         if r.status_code not in [200, 201, 409]:
             err = "Got {} from impala on holding group creation".format(r.status_code)
             raise IOError(err)
+        return r.status_code == 201
 
     def _create_holding(self, hgid, uuid, item):
         data = {'id': uuid,
@@ -178,19 +373,63 @@ class ImpalaSession:
         if r.status_code not in [200, 201, 409]:
             err = "Got {} from impala on holding creation".format(r.status_code)
             raise IOError(err)
+        return r.status_code == 201
+
+    def _metadata_rows(self, track_id, item):
+        rows = []
+        for key, value in item.fields.items():
+            if app.config['IMPALA_SKIP_EMPTY_METADATA'] and \
+                    value in (None, '', 0):
+                continue
+            rows.append({'key': key,
+                         'value': str(value),
+                         'track_id': track_id})
+        return rows
 
     def _create_track_metadata(self, track_id, path, item):
-        for key in item._fields.keys():
-            value = str(getattr(item, key))
-            data = {'key': key,
-                    'value': value,
-                    'track_id': track_id}
-            r = self.put('api/v1/track_metadata', data)
+        self._put_metadata_rows(self._metadata_rows(track_id, item))
+
+    def _put_metadata_rows(self, rows):
+        if self.bulk_metadata:
+            try:
+                self._put_track_metadata_bulk(rows)
+                return
+            except BulkUnsupported:
+                # This impala can't take a list; stop trying for this worker
+                self.bulk_metadata = False
+
+        # Otherwise send one row per request, a few at a time. Iterating over
+        # map() raises the first failure once its request has finished.
+        for _ in self._metadata_pool.map(self._put_track_metadata, rows):
+            pass
+
+    def _put_track_metadata(self, data):
+        r = self.put('api/v1/track_metadata', data)
+        if r.status_code not in [200, 201, 409]:
+            err = "Got {} from impala on metadata creation".format(r.status_code)
+            raise IOError(err)
+
+    def _put_track_metadata_bulk(self, rows):
+        """
+        Sends metadata rows to impala as JSON lists of up to
+        IMPALA_METADATA_BATCH_SIZE rows. Raises BulkUnsupported if impala
+        rejects the first batch.
+        """
+        batch_size = app.config['IMPALA_METADATA_BATCH_SIZE']
+        for start in range(0, len(rows), batch_size):
+            r = self.put_json('api/v1/track_metadata',
+                              rows[start:start + batch_size])
+            if start == 0 and r.status_code in [400, 404, 405, 415]:
+                raise BulkUnsupported("impala has no bulk track_metadata")
             if r.status_code not in [200, 201, 409]:
                 err = "Got {} from impala on metadata creation".format(r.status_code)
                 raise IOError(err)
 
-    def _create_track(self, hid, path, item):
+    def _put_track(self, hgid, hid, path, item):
+        """
+        Creates a track and returns its ID, and whether it is new rather
+        than one impala already had.
+        """
         data = {'title': item.title,
                 'artist': item.artist,
                 'file_path': path,
@@ -214,10 +453,73 @@ class ImpalaSession:
 
         r = self.put('api/v1/tracks', data)
 
+        # The holding we thought existed is gone, so stop trusting the cache
+        if r.status_code == 404:
+            self.forget_holding(hid, hgid)
+
         # We expect a 409 if the resource already exists
         if r.status_code not in [200, 201, 409]:
             err = "Got {} from impala on track creation".format(r.status_code)
             raise IOError(err)
 
-        track_id = r.json()['id']
+        return r.json()['id'], r.status_code == 201
+
+    def _create_track(self, hgid, hid, path, item):
+        track_id, _ = self._put_track(hgid, hid, path, item)
         self._create_track_metadata(track_id, path, item)
+
+
+def _number(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _album_metadata(items):
+    """
+    Returns a TrackMetadata with, for each field, the most common non-empty
+    value among the given tracks, for creating their holding and group.
+    """
+    values = {}
+    for item in items:
+        for key, value in item.fields.items():
+            if value not in (None, ''):
+                values.setdefault(key, Counter())[value] += 1
+    return TrackMetadata({key: counts.most_common(1)[0][0]
+                          for key, counts in values.items()})
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """
+    Returns the ImpalaSession shared by this worker process, creating it on
+    first use.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            server = app.config['IMPALA_SERVER']
+            _session = ImpalaSession(server['uri'], server['username'],
+                                     server['password'],
+                                     pool_size=app.config['IMPALA_POOL_SIZE'],
+                                     cache_size=app.config['IMPALA_CACHE_SIZE'],
+                                     bulk_metadata=app.config['IMPALA_BULK_METADATA'],
+                                     metadata_concurrency=app.config['IMPALA_METADATA_CONCURRENCY'],
+                                     torrent_ttl=app.config['TORRENT_CACHE_TTL'],
+                                     negative_ttl=app.config['TORRENT_CACHE_NEGATIVE_TTL'],
+                                     lookup_concurrency=app.config['TORRENT_LOOKUP_CONCURRENCY'])
+        return _session
+
+
+def _reset_session():
+    # Connections and locks must not be shared with a forked worker
+    global _session, _session_lock
+    _session = None
+    _session_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_session)
@@ -0,0 +1,48 @@
+import time
+from smuggler.db import get_db, register_schema
+
+# What we have successfully stored in both moss and impala, by holding and
+# path, so that re-sent files can be recognized without touching either.
+register_schema("""
+CREATE TABLE IF NOT EXISTS content_index (
+    hid TEXT NOT NULL,
+    path TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (hid, path)
+);
+""")
+
+
+def lookup(hid, path):
+    """
+    Returns the (sha256, size) last stored for a path in a holding, or None.
+    """
+    row = get_db().execute('SELECT sha256, size FROM content_index '
+                           'WHERE hid = ? AND path = ?',
+                           (str(hid), path)).fetchone()
+    if row is None:
+        return None
+    return row['sha256'], row['size']
+
+
+def holding_contents(hid):
+    """
+    Returns {path: (sha256, size)} for everything stored in a holding.
+    """
+    rows = get_db().execute('SELECT path, sha256, size FROM content_index '
+                            'WHERE hid = ?', (str(hid),)).fetchall()
+    return {row['path']: (row['sha256'], row['size']) for row in rows}
+
+
+def record(hid, path, sha256, size):
+    get_db().execute('INSERT OR REPLACE INTO content_index '
+                     '(hid, path, sha256, size, updated) '
+                     'VALUES (?, ?, ?, ?, ?)',
+                     (str(hid), path, sha256, size, time.time()))
+
+
+def forget(hid, path):
+    get_db().execute('DELETE FROM content_index WHERE hid = ? AND path = ?',
+                     (str(hid), path))
@@ -0,0 +1,216 @@
+import os
+import tarfile
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from smuggler import app, albumart, index
+from smuggler.metrics import stage, carry_stages
+from smuggler.registration import register_track
+from smuggler.spool import spool_stream
+from smuggler.tasks import moss_create_track, moss_create_albumart
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Returns the thread pool this worker process uses for upstream transfers
+    that run alongside the request thread.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=app.config['INGEST_THREADS'])
+        return _pool
+
+
+def _reset_pool():
+    global _pool, _pool_lock
+    _pool = None
+    _pool_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_pool)
+
+
+def ingest_track(hgid, hid, spool, path, pool=None):
+    """
+    Stores a spooled track in moss and registers it in impala. The moss
+    upload runs on the given pool, by default the worker pool, while the
+    tags are parsed and impala is updated in the calling thread. Returns
+    once both are finished, raising the first failure if either failed.
+
+    If the index says this exact content is already stored at this path,
+    neither upstream is touched. Returns True if the track was skipped as
+    a duplicate.
+    """
+    if app.config['DEDUP_INDEX']:
+        stored = index.lookup(hid, path)
+        if stored == (spool.sha256, spool.size):
+            return True
+        if stored is not None:
+            # Don't trust the old entry while the new content is in flight
+            index.forget(hid, path)
+
+    with stage('ingest'):
+        moss = (pool or get_pool()).submit(carry_stages(moss_create_track),
+                                           hid, spool.name, path,
+                                           spool.sha256)
+        try:
+            register_track(hgid, hid, spool.name, path)
+        finally:
+            # Never return while moss may still be reading the spool file
+            moss.exception()
+        moss.result()
+
+    if app.config['DEDUP_INDEX']:
+        index.record(hid, path, spool.sha256, spool.size)
+    return False
+
+
+def store_albumart(hid, path, pool=None):
+    """
+    Stores album art in moss along with any derivatives configured in
+    ALBUMART_DERIVATIVES, which are rendered first so that an invalid image
+    is refused before anything is sent. The uploads run in parallel on the
+    given pool, by default the worker pool. Raises albumart.InvalidImage or
+    the first upload failure.
+    """
+    pool = pool or get_pool()
+    derivatives = albumart.make_derivatives(path)
+    try:
+        create = carry_stages(moss_create_albumart)
+        futures = [pool.submit(create, hid, path)]
+        futures += [pool.submit(create, hid, name, size)
+                    for size, name in derivatives]
+        errors = [f.exception() for f in futures]
+        errors = [e for e in errors if e is not None]
+        if errors:
+            raise errors[0]
+    finally:
+        for _, name in derivatives:
+            os.unlink(name)
+
+
+class InvalidArchive(ValueError):
+    """
+    Raised when an uploaded holding archive can't be read as a tar or zip
+    archive.
+    """
+
+
+class _PrefixedStream:
+    """
+    A read-only stream that returns some already-consumed bytes before the
+    rest of the underlying stream, so that we can sniff magic bytes without
+    needing to seek.
+    """
+    def __init__(self, prefix, stream):
+        self.prefix = prefix
+        self.stream = stream
+
+    def read(self, size=-1):
+        if not self.prefix:
+            return self.stream.read(size)
+        if size is None or size < 0:
+            data = self.prefix + self.stream.read()
+            self.prefix = b''
+            return data
+        data = self.prefix[:size]
+        self.prefix = self.prefix[size:]
+        if len(data) < size:
+            data += self.stream.read(size - len(data))
+        return data
+
+
+def _member_path(name):
+    """
+    Returns the path within the holding for an archive member, or None if
+    it would escape the holding.
+    """
+    parts = [p for p in name.replace('\\', '/').split('/') if p not in ('', '.')]
+    if not parts or '..' in parts:
+        return None
+    return '/'.join(parts)
+
+
+def _archive_members(stream):
+    """
+    Yields (path, fileobj) for each regular file in a tar or zip archive.
+    Tar archives, compressed or not, are read as a stream; zip archives keep
+    their index at the end, so they are spooled to disk first.
+    """
+    magic = stream.read(4)
+    stream = _PrefixedStream(magic, stream)
+
+    if magic == b'PK\x03\x04':
+        spool = spool_stream(stream)
+        try:
+            with zipfile.ZipFile(spool.name) as archive:
+                for info in archive.infolist():
+                    path = _member_path(info.filename)
+                    if info.is_dir() or path is None:
+                        continue
+                    with archive.open(info) as f:
+                        yield path, f
+        finally:
+            os.unlink(spool.name)
+    else:
+        with tarfile.open(fileobj=stream, mode='r|*') as archive:
+            for info in archive:
+                path = _member_path(info.name)
+                if not info.isreg() or path is None:
+                    continue
+                yield path, archive.extractfile(info)
+
+
+def ingest_archive(hgid, hid, stream):
+    """
+    Ingests every file in an archive of a whole holding. Members are spooled
+    one at a time as the archive is read and handed to a bounded pool, so
+    several tracks are processed in parallel while the rest of the archive
+    is still arriving. Files named like album art are also stored as the
+    holding's album art. Returns the paths that were ingested, raising the
+    first failure once all started files have finished, or InvalidArchive if
+    the archive turns out to be unreadable.
+    """
+    art_names = app.config['ALBUMART_FILENAMES']
+    concurrency = app.config['ARCHIVE_CONCURRENCY']
+    # Also bounds how many spooled members can be waiting on disk
+    slots = threading.BoundedSemaphore(concurrency)
+    paths = []
+    futures = []
+
+    @carry_stages
+    def process(path, spool):
+        try:
+            ingest_track(hgid, hid, spool, path)
+            if os.path.basename(path).lower() in art_names:
+                try:
+                    store_albumart(hid, spool.name)
+                except albumart.InvalidImage:
+                    app.logger.warning("Not using %s in %s as album art",
+                                       path, hid)
+        finally:
+            os.unlink(spool.name)
+            slots.release()
+
+    # Leaving the with block waits for every file that was started
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for path, f in _archive_members(stream):
+                slots.acquire()
+                try:
+                    spool = spool_stream(f)
+                except:
+                    slots.release()
+                    raise
+                futures.append(pool.submit(process, path, spool))
+                paths.append(path)
+    except (tarfile.TarError, zipfile.BadZipFile) as e:
+        raise InvalidArchive("Not a readable tar or zip archive: {}".format(e))
+
+    for future in futures:
+        future.result()
+    return paths
@@ -0,0 +1,83 @@
+import os
+import threading
+import time
+from smuggler import app, registration, spool, torrents, uploads
+from smuggler.db import get_db
+from smuggler.jobs import QUEUED, RUNNING
+from smuggler.metrics import SPOOL_RECLAIMED_FILES, SPOOL_RECLAIMED_BYTES
+
+# Prefixes of the files we create in TEMP_DIR; anything else is left alone
+SPOOL_PREFIXES = ('tmp', 'upload')
+
+_janitor_pid = None
+_janitor_lock = threading.Lock()
+
+
+def _files_in_use():
+    rows = get_db().execute(
+        'SELECT tmpfname FROM jobs WHERE status IN (?, ?) '
+        'UNION SELECT tmpfname FROM upload_sessions',
+        (QUEUED, RUNNING)).fetchall()
+    return {row['tmpfname'] for row in rows}
+
+
+def reclaim():
+    """
+    Removes expired resumable uploads, staged tracks and cached torrent
+    lookups, then any spool file in TEMP_DIR older than SPOOL_MAX_AGE that
+    no queued job or upload session refers to. These are left behind when a
+    worker is killed mid-request. Returns the number of files removed.
+    """
+    uploads.expire_sessions()
+    registration.expire_staged()
+    torrents.expire()
+
+    temp_dir = app.config['TEMP_DIR']
+    cutoff = time.time() - app.config['SPOOL_MAX_AGE']
+    in_use = _files_in_use()
+    removed = 0
+
+    for entry in os.scandir(temp_dir):
+        if not entry.name.startswith(SPOOL_PREFIXES) or \
+                not entry.is_file(follow_symlinks=False):
+            continue
+        if entry.path in in_use:
+            continue
+        try:
+            st = entry.stat(follow_symlinks=False)
+            if st.st_mtime >= cutoff:
+                continue
+            os.unlink(entry.path)
+        except FileNotFoundError:
+            continue
+
+        removed += 1
+        spool.stats['reclaimed_files'] += 1
+        spool.stats['reclaimed_bytes'] += st.st_size
+        SPOOL_RECLAIMED_FILES.inc()
+        SPOOL_RECLAIMED_BYTES.inc(st.st_size)
+        app.logger.info("Reclaimed orphaned spool file %s", entry.path)
+
+    return removed
+
+
+def _run():
+    while True:
+        time.sleep(app.config['SPOOL_JANITOR_INTERVAL'])
+        try:
+            reclaim()
+        except Exception:
+            app.logger.exception("Spool janitor failed")
+
+
+def start_janitor():
+    """
+    Starts this process's janitor thread if it isn't running yet.
+    """
+    global _janitor_pid
+    with _janitor_lock:
+        if _janitor_pid == os.getpid():
+            return
+        _janitor_pid = os.getpid()
+
+    threading.Thread(target=_run, name='smuggler-janitor', daemon=True).start()
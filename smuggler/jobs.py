@@ -0,0 +1,263 @@
+import os
+import threading
+import time
+import uuid
+from smuggler import albumart, app
+from smuggler.db import get_db, register_schema, process_id
+from smuggler.db import expire_processes
+from smuggler.ingest import ingest_track, store_albumart
+from smuggler.spool import SpoolFile
+from smuggler.upstream import UpstreamUnavailable
+
+# Jobs live in the state database so that spooled uploads that were accepted
+# with a 202 are still processed after smuggler restarts.
+register_schema("""
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    hgid TEXT,
+    hid TEXT NOT NULL,
+    path TEXT,
+    tmpfname TEXT NOT NULL,
+    sha256 TEXT,
+    size INTEGER,
+    status TEXT NOT NULL,
+    deduplicated INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    owner TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    deferrals INTEGER NOT NULL DEFAULT 0,
+    not_before REAL NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created);
+CREATE INDEX IF NOT EXISTS jobs_hid ON jobs (hid);
+""")
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+# A failed job whose target has since been uploaded again
+SUPERSEDED = 'superseded'
+
+_workers_pid = None
+_workers_lock = threading.Lock()
+_wakeup = threading.Event()
+
+
+def _job_dict(row):
+    return {'id': row['id'],
+            'kind': row['kind'],
+            'hgid': row['hgid'],
+            'hid': row['hid'],
+            'path': row['path'],
+            'status': row['status'],
+            'deduplicated': bool(row['deduplicated']),
+            'error': row['error'],
+            'attempts': row['attempts'],
+            'not_before': row['not_before'],
+            'created': row['created'],
+            'updated': row['updated']}
+
+
+def enqueue(kind, hid, spool, hgid=None, path=None):
+    """
+    Queues a SpoolFile for processing by the background workers and returns
+    the new job's ID. The workers take ownership of the spooled file. Failed
+    jobs for the same track, or the holding's album art, are superseded by
+    the new one so that they no longer keep the holding from being locked.
+    """
+    job_id = str(uuid.uuid4())
+    now = time.time()
+    db = get_db()
+    db.execute('UPDATE jobs SET status = ?, updated = ? WHERE hid = ? AND '
+               'kind = ? AND path IS ? AND status = ?',
+               (SUPERSEDED, now, str(hid), kind, path, FAILED))
+    db.execute(
+        'INSERT INTO jobs (id, kind, hgid, hid, path, tmpfname, sha256, size, '
+        'status, created, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        (job_id, kind, str(hgid) if hgid else None, str(hid), path,
+         spool.name, spool.sha256, spool.size, QUEUED, now, now))
+
+    start_workers()
+    _wakeup.set()
+    return job_id
+
+
+def get_job(job_id):
+    """
+    Returns a job's status as a dict, or None if there is no such job.
+    """
+    row = get_db().execute('SELECT * FROM jobs WHERE id = ?',
+                           (job_id,)).fetchone()
+    if row is None:
+        return None
+    return _job_dict(row)
+
+
+def holding_jobs(hid):
+    """
+    Summarizes the jobs for a holding: a count per status and the jobs
+    themselves, oldest first.
+    """
+    rows = get_db().execute('SELECT * FROM jobs WHERE hid = ? '
+                            'ORDER BY created', (str(hid),)).fetchall()
+    counts = {QUEUED: 0, RUNNING: 0, DONE: 0, FAILED: 0, SUPERSEDED: 0}
+    for row in rows:
+        counts[row['status']] += 1
+
+    return {'hid': str(hid),
+            'complete': counts[QUEUED] == 0 and counts[RUNNING] == 0,
+            'counts': counts,
+            'jobs': [_job_dict(row) for row in rows]}
+
+
+def wait_for_holding(hid, timeout):
+    """
+    Waits up to timeout seconds for all of a holding's jobs to finish and
+    returns the summary from holding_jobs().
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        summary = holding_jobs(hid)
+        if summary['complete'] or time.monotonic() >= deadline:
+            return summary
+        time.sleep(app.config['JOB_POLL_INTERVAL'])
+
+
+def start_workers():
+    """
+    Starts this process's background workers if they aren't running yet.
+    """
+    global _workers_pid
+    with _workers_lock:
+        if _workers_pid == os.getpid():
+            return
+        _workers_pid = os.getpid()
+
+    for n in range(app.config['JOB_WORKERS']):
+        t = threading.Thread(target=_worker, name='smuggler-job-{}'.format(n),
+                             daemon=True)
+        t.start()
+
+
+def _requeue_orphans(db):
+    """
+    Puts jobs back in the queue whose worker process has died, which shows
+    as its lease having expired, unless they have used up their attempts.
+    """
+    expire_processes(db)
+    orphaned = 'status = ? AND (owner IS NULL OR ' \
+        'owner NOT IN (SELECT id FROM processes))'
+    now = time.time()
+    db.execute('UPDATE jobs SET status = ?, owner = NULL, error = ?, '
+               'updated = ? WHERE attempts >= ? AND ' + orphaned,
+               (FAILED, "worker died", now, app.config['JOB_MAX_ATTEMPTS'],
+                RUNNING))
+    db.execute('UPDATE jobs SET status = ?, owner = NULL, updated = ? '
+               'WHERE ' + orphaned, (QUEUED, now, RUNNING))
+
+
+def _claim():
+    owner = process_id()
+    db = get_db()
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        _requeue_orphans(db)
+        row = db.execute('SELECT * FROM jobs WHERE status = ? AND '
+                         'not_before <= ? ORDER BY created LIMIT 1',
+                         (QUEUED, time.time())).fetchone()
+        if row is not None:
+            db.execute('UPDATE jobs SET status = ?, owner = ?, '
+                       'attempts = attempts + 1, updated = ? WHERE id = ?',
+                       (RUNNING, owner, time.time(), row['id']))
+        db.execute('COMMIT')
+    except:
+        db.execute('ROLLBACK')
+        raise
+    return row
+
+
+def _run(job):
+    """
+    Processes a claimed job, returning True if it turned out to be a
+    duplicate of content that was already stored.
+    """
+    if job['kind'] == 'track':
+        spool = SpoolFile(job['tmpfname'], job['size'], job['sha256'])
+        return ingest_track(job['hgid'], job['hid'], spool, job['path'])
+    elif job['kind'] == 'albumart':
+        store_albumart(job['hid'], job['tmpfname'])
+        return False
+    else:
+        raise ValueError("Unknown job kind " + job['kind'])
+
+
+def _finish(job, status, error=None, deduplicated=False):
+    get_db().execute('UPDATE jobs SET status = ?, error = ?, owner = NULL, '
+                     'deduplicated = ?, updated = ? WHERE id = ?',
+                     (status, error, int(deduplicated), time.time(),
+                      job['id']))
+
+
+def _retry(job, error, delay, attempt=True):
+    """
+    Puts a failed job back in the queue to be claimed again in delay
+    seconds. Unless attempt is true, the failure isn't counted against
+    JOB_MAX_ATTEMPTS.
+    """
+    now = time.time()
+    get_db().execute('UPDATE jobs SET status = ?, error = ?, owner = NULL, '
+                     'attempts = attempts - ?, deferrals = deferrals + ?, '
+                     'not_before = ?, updated = ? WHERE id = ?',
+                     (QUEUED, error, 0 if attempt else 1, 0 if attempt else 1,
+                      now + delay, now, job['id']))
+
+
+def _backoff(n):
+    return min(app.config['JOB_RETRY_BACKOFF'] * 2 ** n,
+               app.config['JOB_MAX_RETRY_BACKOFF'])
+
+
+def _worker():
+    while True:
+        try:
+            job = _claim()
+        except Exception:
+            app.logger.exception("Failed to claim an ingest job")
+            job = None
+
+        if job is None:
+            _wakeup.wait(app.config['JOB_POLL_INTERVAL'])
+            _wakeup.clear()
+            continue
+
+        try:
+            deduplicated = _run(job)
+        except UpstreamUnavailable as e:
+            # The job isn't at fault, so it waits out the outage however
+            # long it lasts, keeping its spooled file
+            app.logger.warning("Deferring ingest job %s: %s", job['id'], e)
+            _retry(job, str(e), max(e.retry_after, _backoff(job['deferrals'])),
+                   attempt=False)
+            continue
+        except albumart.InvalidImage as e:
+            # Retrying won't make the image usable
+            app.logger.warning("Ingest job %s failed: %s", job['id'], e)
+            _finish(job, FAILED, str(e))
+        except Exception as e:
+            app.logger.exception("Ingest job %s failed", job['id'])
+            # attempts was already incremented when the job was claimed
+            if job['attempts'] + 1 < app.config['JOB_MAX_ATTEMPTS']:
+                _retry(job, str(e), _backoff(job['attempts']))
+                continue
+            _finish(job, FAILED, str(e))
+        else:
+            _finish(job, DONE, deduplicated=deduplicated)
+
+        try:
+            os.unlink(job['tmpfname'])
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,250 @@
+import math
+import time
+import uuid
+from functools import wraps
+from flask import request, Response
+from smuggler import app
+from smuggler.db import get_db, register_schema, process_id
+from smuggler.db import expire_processes
+
+# Uploads that are running or waiting for a turn, each user's token bucket
+# and fair queueing tag, and the queue's virtual clock, shared by every
+# worker through the state database.
+register_schema("""
+CREATE TABLE IF NOT EXISTS upload_slots (
+    id TEXT PRIMARY KEY,
+    user TEXT NOT NULL,
+    owner TEXT NOT NULL,
+    tag REAL NOT NULL,
+    admitted INTEGER NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS upload_slots_user ON upload_slots (user);
+CREATE TABLE IF NOT EXISTS user_budgets (
+    user TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL,
+    finish REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS fair_queue_clock (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    vtime REAL NOT NULL
+);
+INSERT OR IGNORE INTO fair_queue_clock (id, vtime) VALUES (0, 0);
+""")
+
+
+class OverBudget(Exception):
+    """
+    Raised when a user has used up their request rate or concurrency.
+    """
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def user_limits(user):
+    limits = dict(app.config['DEFAULT_USER_LIMITS'])
+    limits.update(app.config['USER_LIMITS'].get(user, {}))
+    return limits
+
+
+def _transaction(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        # The lease has to exist before the transaction can take it
+        process_id()
+        db = get_db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            result = f(db, *args, **kwargs)
+            db.execute('COMMIT')
+        except:
+            db.execute('ROLLBACK')
+            raise
+        return result
+    return decorated
+
+
+def _remove_orphans(db):
+    # Slots held by workers that have died would otherwise never be freed,
+    # and a waiting one would block the head of the queue
+    expire_processes(db)
+    db.execute('DELETE FROM upload_slots '
+               'WHERE owner NOT IN (SELECT id FROM processes)')
+
+
+def _charge(db, user, limits):
+    """
+    Takes one request from the user's token bucket, which refills at
+    limits['rate'] per second up to limits['burst'], raising OverBudget if
+    it is empty. Returns the upload's start tag for fair queueing: the
+    later of the queue's virtual clock and the user's previous upload's
+    finish tag, which is 1/weight later than its start.
+    """
+    now = time.time()
+    row = db.execute('SELECT tokens, updated, finish FROM user_budgets '
+                     'WHERE user = ?', (user,)).fetchone()
+    tokens = limits['burst']
+    finish = 0
+    if row is not None:
+        tokens = min(limits['burst'],
+                     row['tokens'] + (now - row['updated']) * limits['rate'])
+        finish = row['finish']
+
+    if tokens < 1:
+        raise OverBudget("request rate limit exceeded",
+                         math.ceil((1 - tokens) / limits['rate']))
+
+    vtime = db.execute('SELECT vtime FROM fair_queue_clock').fetchone()[0]
+    tag = max(vtime, finish)
+    db.execute('INSERT OR REPLACE INTO user_budgets '
+               '(user, tokens, updated, finish) VALUES (?, ?, ?, ?)',
+               (user, tokens - 1, now, tag + 1 / limits['weight']))
+    return tag
+
+
+@_transaction
+def request_slot(db, user):
+    """
+    Charges an upload to the user's budgets and joins the queue for an
+    upload slot. Returns the slot's ID, for poll_slot() and release_slot().
+    Raises OverBudget if the user is over their request rate or already has
+    their limit of uploads running or waiting.
+    """
+    limits = user_limits(user)
+    owner = process_id()
+    _remove_orphans(db)
+
+    slots = db.execute('SELECT COUNT(*) FROM upload_slots WHERE user = ?',
+                       (user,)).fetchone()[0]
+    if slots >= limits['concurrency']:
+        raise OverBudget("too many uploads in progress",
+                         app.config['USER_LIMIT_RETRY_AFTER'])
+    tag = _charge(db, user, limits)
+
+    slot_id = str(uuid.uuid4())
+    db.execute('INSERT INTO upload_slots '
+               '(id, user, owner, tag, admitted, created) '
+               'VALUES (?, ?, ?, ?, 0, ?)',
+               (slot_id, user, owner, tag, time.time()))
+    return slot_id
+
+
+def _queue_position(db, slot_id):
+    """
+    Returns (admitted, tag): whether the slot has already been admitted,
+    and if it hasn't, its start tag if it may be admitted now or else None.
+    Slots of processes whose lease has expired are ignored.
+    """
+    rows = db.execute('SELECT id, tag, admitted FROM upload_slots '
+                      'WHERE owner IN (SELECT id FROM processes '
+                      'WHERE heartbeat >= ?) ORDER BY tag, created',
+                      (time.time() - app.config['PROCESS_LEASE_TTL'],)
+                      ).fetchall()
+    mine = next((row for row in rows if row['id'] == slot_id), None)
+    if mine is None or mine['admitted']:
+        return mine is not None, None
+
+    running = sum(row['admitted'] for row in rows)
+    max_active = app.config['MAX_ACTIVE_UPLOADS']
+    if max_active is not None and running >= max_active:
+        return False, None
+
+    waiting = [row for row in rows if not row['admitted']]
+    if waiting[0]['id'] != slot_id:
+        return False, None
+    return False, mine['tag']
+
+
+def poll_slot(slot_id):
+    """
+    Returns whether the upload may start. While fewer than
+    MAX_ACTIVE_UPLOADS are running, waiting uploads are admitted in order
+    of their start tags (start-time fair queueing), so each user gets slots
+    in proportion to their weight and one user's bulk import can't starve
+    everyone else. The queue is read without locking the database, which is
+    only locked to admit the upload once its turn seems to have come.
+    """
+    admitted, tag = _queue_position(get_db(), slot_id)
+    if admitted or tag is None:
+        return admitted
+    return _admit(slot_id)
+
+
+@_transaction
+def _admit(db, slot_id):
+    _remove_orphans(db)
+    # Another worker may have admitted an upload since we looked
+    admitted, tag = _queue_position(db, slot_id)
+    if admitted or tag is None:
+        return admitted
+
+    db.execute('UPDATE upload_slots SET admitted = 1 WHERE id = ?',
+               (slot_id,))
+    db.execute('UPDATE fair_queue_clock SET vtime = MAX(vtime, ?)', (tag,))
+    return True
+
+
+def release_slot(slot_id):
+    get_db().execute('DELETE FROM upload_slots WHERE id = ?', (slot_id,))
+
+
+class SlotRequest:
+    """
+    An upload's place in the queue for a slot. Call poll() every
+    FAIR_QUEUE_POLL_INTERVAL seconds until it returns True, sleeping however
+    suits the caller; the slot is given up if waiting fails.
+    """
+    def __init__(self, user):
+        self.id = request_slot(user)
+        self.deadline = time.monotonic() + app.config['FAIR_QUEUE_TIMEOUT']
+
+    def poll(self):
+        """
+        Returns whether the upload may start, raising OverBudget once it has
+        waited FAIR_QUEUE_TIMEOUT seconds.
+        """
+        try:
+            if poll_slot(self.id):
+                return True
+            if time.monotonic() >= self.deadline:
+                raise OverBudget("timed out waiting for an upload slot",
+                                 app.config['USER_LIMIT_RETRY_AFTER'])
+        except:
+            release_slot(self.id)
+            raise
+        return False
+
+
+def wait_for_slot(user):
+    """
+    Queues for an upload slot and waits for it, for up to
+    FAIR_QUEUE_TIMEOUT seconds. Returns the slot's ID.
+    """
+    slot = SlotRequest(user)
+    while not slot.poll():
+        time.sleep(app.config['FAIR_QUEUE_POLL_INTERVAL'])
+    return slot.id
+
+
+def requires_fair_share(f):
+    """
+    Holds an upload until it is the authenticated user's fair turn, and
+    refuses it with a 429 if the user is over budget. Must come after
+    requires_auth.
+    """
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        slot_id = wait_for_slot(request.authorization.username)
+        try:
+            return f(*args, **kwargs)
+        finally:
+            release_slot(slot_id)
+    return decorated
+
+
+@app.errorhandler(OverBudget)
+def over_budget(e):
+    """Sends a 429 response asking the client to slow down"""
+    return Response(str(e) + '\n', 429, {'Retry-After': str(e.retry_after)})
@@ -0,0 +1,190 @@
+import importlib
+import os
+import re
+from smuggler import app
+
+# Leading bytes of the audio containers we know how to read tags from, as
+# (offset, magic) pairs. Anything else is stored in moss but never parsed.
+AUDIO_MAGIC = [
+    (0, b'fLaC'),               # FLAC
+    (0, b'ID3'),                # MP3 (or anything else) with an ID3v2 tag
+    (0, b'OggS'),               # Ogg Vorbis, Opus, FLAC
+    (4, b'ftyp'),               # MP4/M4A
+    (0, b'wvpk'),               # WavPack
+    (0, b'MAC '),               # Monkey's Audio
+    (0, b'MPCK'),               # Musepack SV8
+    (0, b'MP+'),                # Musepack SV7
+    (0, b'TTA1'),               # True Audio
+    (0, b'DSD '),               # DSF
+    (0, b'\x30\x26\xb2\x75'),   # ASF/WMA
+]
+
+# The fields of a beets Item, as of the beets in requirements.txt, with the
+# value beets gives each one when the file doesn't have it. Both backends
+# return exactly these, so impala gets the same track_metadata rows from
+# either. Fields that aren't tags are filled in as Item.from_path() does.
+ITEM_FIELDS = [
+    ('id', None), ('path', None), ('album_id', None),
+    ('title', ''), ('artist', ''), ('artist_sort', ''),
+    ('artist_credit', ''), ('album', ''), ('albumartist', ''),
+    ('albumartist_sort', ''), ('albumartist_credit', ''), ('genre', ''),
+    ('lyricist', ''), ('composer', ''), ('arranger', ''), ('grouping', ''),
+    ('year', 0), ('month', 0), ('day', 0), ('track', 0), ('tracktotal', 0),
+    ('disc', 0), ('disctotal', 0), ('lyrics', ''), ('comments', ''),
+    ('bpm', 0), ('comp', False), ('mb_trackid', ''), ('mb_albumid', ''),
+    ('mb_artistid', ''), ('mb_albumartistid', ''), ('albumtype', ''),
+    ('label', ''), ('acoustid_fingerprint', ''), ('acoustid_id', ''),
+    ('mb_releasegroupid', ''), ('asin', ''), ('catalognum', ''),
+    ('script', ''), ('language', ''), ('country', ''), ('albumstatus', ''),
+    ('media', ''), ('albumdisambig', ''), ('disctitle', ''), ('encoder', ''),
+    ('rg_track_gain', None), ('rg_track_peak', None),
+    ('rg_album_gain', None), ('rg_album_peak', None),
+    ('original_year', 0), ('original_month', 0), ('original_day', 0),
+    ('initial_key', None), ('length', 0.0), ('bitrate', 0), ('format', ''),
+    ('samplerate', 0), ('bitdepth', 0), ('channels', 0), ('mtime', None),
+    ('added', None),
+]
+
+# beets spells musical keys with sharps
+_ENHARMONIC = {'db': 'c#', 'eb': 'd#', 'gb': 'f#', 'ab': 'g#', 'bb': 'a#'}
+
+
+class TrackMetadata:
+    """
+    The tags of one track, named like beets Item fields. Fields that the
+    file didn't have read as an empty string, as they would from beets.
+    """
+    def __init__(self, fields):
+        self.fields = fields
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['fields'][name]
+        except KeyError:
+            if name.startswith('__'):
+                raise AttributeError(name)
+            return ''
+
+
+def is_audio(path):
+    """
+    Checks the first few bytes of a file against the audio formats we know.
+    """
+    with open(path, 'rb') as f:
+        head = f.read(16)
+
+    if len(head) >= 2 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0:
+        return True         # MPEG audio or ADTS frame sync
+    if head[:4] == b'RIFF' and head[8:12] == b'WAVE':
+        return True
+    if head[:4] == b'FORM' and head[8:12] in (b'AIFF', b'AIFC'):
+        return True
+    return any(head[offset:offset + len(magic)] == magic
+               for offset, magic in AUDIO_MAGIC)
+
+
+def _media_file():
+    try:
+        # Part of beets itself up to 1.4.7, without its library or plugins
+        from beets.mediafile import MediaFile, FileTypeError
+    except ImportError:
+        from mediafile import MediaFile, FileTypeError
+    return MediaFile, FileTypeError
+
+
+def _musical_key(key):
+    key = key.lower()
+    for flat, sharp in _ENHARMONIC.items():
+        key = key.replace(flat, sharp)
+    key = re.sub(r'[\W\s]+minor', 'm', key)
+    key = re.sub(r'[\W\s]+major', '', key)
+    return key.capitalize()
+
+
+def _read_mutagen(path):
+    """
+    Reads just the tags and stream info, with the MediaFile that beets uses
+    on top of mutagen, into the same fields and values as a beets Item.
+    """
+    MediaFile, FileTypeError = _media_file()
+    try:
+        f = MediaFile(path)
+    except FileTypeError:
+        return None
+
+    fields = {}
+    for field, null in ITEM_FIELDS:
+        value = getattr(f, field, None)
+        # As beets does, for its 64 bit SQLite columns
+        if isinstance(value, int) and value.bit_length() > 63:
+            value = 0
+        if value is None:
+            value = null
+        elif field == 'initial_key':
+            value = _musical_key(value)
+        fields[field] = value
+
+    fields['path'] = os.fsencode(os.path.abspath(path))
+    fields['mtime'] = int(os.path.getmtime(path))
+    return TrackMetadata(fields)
+
+
+def _read_beets(path):
+    from beets.library import Item
+    item = Item.from_path(path)
+    return TrackMetadata({key: getattr(item, key)
+                          for key in item._fields.keys()})
+
+
+def _preload_mutagen():
+    # MediaFile imports mutagen's modules for every format it reads
+    _media_file()
+
+
+def _preload_beets():
+    importlib.import_module('beets.library')
+
+
+BACKENDS = {
+    'mutagen': _read_mutagen,
+    'beets': _read_beets,
+}
+
+PRELOADERS = {
+    'mutagen': _preload_mutagen,
+    'beets': _preload_beets,
+}
+
+
+def read_metadata(path):
+    """
+    Returns the TrackMetadata for an audio file, or None if it isn't one.
+    The backends in METADATA_BACKENDS are tried in turn until one of them
+    can parse the file; backends whose library isn't installed are skipped.
+    """
+    if not is_audio(path):
+        return None
+
+    for name in app.config['METADATA_BACKENDS']:
+        try:
+            metadata = BACKENDS[name](path)
+        except ImportError:
+            continue
+        except Exception:
+            app.logger.warning("%s could not read tags from %s", name, path)
+            continue
+        if metadata is not None:
+            return metadata
+    return None
+
+
+def preload():
+    """
+    Imports the libraries of the METADATA_BACKENDS that are installed, which
+    read_metadata() would otherwise load on the first upload.
+    """
+    for name in app.config['METADATA_BACKENDS']:
+        try:
+            PRELOADERS[name]()
+        except ImportError:
+            continue
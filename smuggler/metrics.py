@@ -0,0 +1,162 @@
+import atexit
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from flask import Response
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram
+from prometheus_client import REGISTRY, CONTENT_TYPE_LATEST, generate_latest
+from prometheus_client import multiprocess
+from prometheus_client.core import GaugeMetricFamily
+from smuggler import app
+from smuggler.auth import requires_auth
+
+# Under uWSGI every worker is a separate process, so prometheus_client keeps
+# its values in files in this directory and /metrics adds them up.
+MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+if MULTIPROC_DIR:
+    os.makedirs(MULTIPROC_DIR, exist_ok=True)
+    # Lets the in-flight gauge forget workers that have exited
+    atexit.register(lambda: multiprocess.mark_process_dead(os.getpid()))
+
+STAGE_SECONDS = Histogram(
+    'smuggler_stage_seconds', "Time spent in each upload pipeline stage",
+    ['stage'],
+    buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120))
+IMPALA_REQUESTS = Counter(
+    'smuggler_impala_requests_total', "Requests made to impala",
+    ['method', 'endpoint', 'status'])
+MOSS_REQUESTS = Counter(
+    'smuggler_moss_requests_total', "Requests made to moss", ['status'])
+MOSS_BYTES = Counter(
+    'smuggler_moss_bytes_total', "Bytes of file content sent to moss")
+UPLOADS_IN_FLIGHT = Gauge(
+    'smuggler_uploads_in_flight', "Uploads currently being handled",
+    multiprocess_mode='livesum')
+UPSTREAM_RETRIES = Counter(
+    'smuggler_upstream_retries_total',
+    "Calls to moss or impala that were retried after a transient failure",
+    ['upstream'])
+CIRCUIT_OPENED = Counter(
+    'smuggler_circuit_opened_total',
+    "Times calls to moss or impala started failing fast", ['upstream'])
+SPOOL_ADMISSIONS = Counter(
+    'smuggler_spool_admissions_total',
+    "Uploads admitted or refused by spool admission control", ['result'])
+SPOOL_RECLAIMED_FILES = Counter(
+    'smuggler_spool_reclaimed_files_total',
+    "Orphaned spool files removed by the janitor")
+SPOOL_RECLAIMED_BYTES = Counter(
+    'smuggler_spool_reclaimed_bytes_total',
+    "Bytes of orphaned spool files removed by the janitor")
+
+# Collapse IDs in impala paths so each endpoint is a single label value
+_ID_RE = re.compile(r'/[0-9a-fA-F-]{32,}(?=/|$)')
+
+
+def impala_endpoint(endpoint):
+    """
+    Returns the label for an impala endpoint, without its query string or
+    any UUIDs and hashes in the path.
+    """
+    return _ID_RE.sub('/<id>', endpoint.split('?', 1)[0])
+
+
+_recording = threading.local()
+
+
+@contextmanager
+def stage(name):
+    """
+    Times the enclosed block as one pipeline stage.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.labels(name).observe(elapsed)
+        stages = getattr(_recording, 'stages', None)
+        if stages is not None:
+            stages.append((name, elapsed))
+
+
+def record_stages():
+    """
+    Starts keeping the (name, seconds) of each stage that this thread runs,
+    in the list that is returned, until stop_recording() is called.
+    """
+    _recording.stages = []
+    return _recording.stages
+
+
+def stop_recording():
+    _recording.stages = None
+
+
+def carry_stages(f):
+    """
+    Wraps f, which is about to be handed to another thread such as a pool
+    worker, so that the stages it runs there are recorded along with this
+    thread's.
+    """
+    stages = getattr(_recording, 'stages', None)
+    if stages is None:
+        return f
+
+    @wraps(f)
+    def recorded(*args, **kwargs):
+        _recording.stages = stages
+        try:
+            return f(*args, **kwargs)
+        finally:
+            _recording.stages = None
+    return recorded
+
+
+class SpoolCollector:
+    """
+    Reports the disk used by spool files when scraped, since that is shared
+    by all workers rather than counted by any one of them.
+    """
+    def collect(self):
+        from smuggler.janitor import SPOOL_PREFIXES
+
+        files = 0
+        size = 0
+        for entry in os.scandir(app.config['TEMP_DIR']):
+            if entry.name.startswith(SPOOL_PREFIXES) and \
+                    entry.is_file(follow_symlinks=False):
+                try:
+                    size += entry.stat(follow_symlinks=False).st_size
+                except FileNotFoundError:
+                    continue
+                files += 1
+
+        yield GaugeMetricFamily('smuggler_spool_files',
+                                "Spool files in TEMP_DIR", value=files)
+        yield GaugeMetricFamily('smuggler_spool_bytes',
+                                "Bytes used by spool files in TEMP_DIR",
+                                value=size)
+
+
+def _registry():
+    if MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return registry
+
+
+_spool_registry = CollectorRegistry()
+_spool_registry.register(SpoolCollector())
+
+
+@app.route('/metrics')
+@requires_auth
+def metrics():
+    data = generate_latest(_registry()) + generate_latest(_spool_registry)
+    return Response(data, mimetype=CONTENT_TYPE_LATEST)
@@ -0,0 +1,34 @@
+import gc
+from smuggler import albumart, app, metadata
+
+try:
+    import uwsgi
+except ImportError:
+    uwsgi = None
+
+
+def wanted():
+    """
+    Returns whether to preload: as PRELOAD says, or if it is None, when the
+    app is being loaded by a uWSGI master that will fork its workers from
+    it, rather than by each worker under --lazy-apps.
+    """
+    if app.config['PRELOAD'] is not None:
+        return app.config['PRELOAD']
+    if uwsgi is None:
+        return False
+    return not (uwsgi.opt.get('lazy-apps') or uwsgi.opt.get('lazy'))
+
+
+def preload():
+    """
+    Loads the libraries that smuggler otherwise imports on first use, so
+    that workers forked from this process share them copy-on-write rather
+    than each importing its own. Nothing that holds sockets, threads or
+    locks is created here, since none of those survive a fork.
+    """
+    metadata.preload()
+    albumart.preload()
+    # Keep the collector in each worker from writing to, and so copying,
+    # every page of objects the master loaded
+    gc.freeze()
@@ -0,0 +1,103 @@
+import cProfile
+import os
+import random
+import re
+import time
+import uuid
+from collections import OrderedDict
+from flask import g, request
+from smuggler import app
+from smuggler.api.v1 import bp
+from smuggler.auth import check_auth
+from smuggler.metrics import record_stages, stop_recording
+
+PROFILE_HEADER = 'X-Smuggler-Profile'
+
+# Request IDs from clients end up in file names
+_REQUEST_ID_RE = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+
+def _wanted():
+    if PROFILE_HEADER not in request.headers and \
+            random.random() >= app.config['PROFILE_SAMPLE_RATE']:
+        return False
+    auth = request.authorization
+    return bool(auth) and check_auth(auth.username, auth.password)
+
+
+def _request_id():
+    request_id = request.headers.get('X-Request-ID', '')
+    if _REQUEST_ID_RE.match(request_id):
+        return request_id
+    return uuid.uuid4().hex
+
+
+@bp.before_request
+def start_profile():
+    """
+    Profiles this request if it asked to be, or was sampled, and came with
+    valid credentials. Otherwise the only cost is the header lookup.
+    """
+    if not _wanted():
+        return
+
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        # Another request in this process is already being profiled
+        return
+    g.profile = profile
+    g.profile_id = _request_id()
+    g.profile_start = time.perf_counter()
+    g.profile_stages = record_stages()
+
+
+def _server_timing(stages, total):
+    durations = OrderedDict()
+    for name, seconds in stages:
+        durations[name] = durations.get(name, 0) + seconds
+    durations['total'] = total
+    return ', '.join('{};dur={:.1f}'.format(name, seconds * 1000)
+                     for name, seconds in durations.items())
+
+
+def _stop():
+    profile = g.pop('profile', None)
+    if profile is None:
+        return None
+    profile.disable()
+    stop_recording()
+
+    profile_dir = app.config['PROFILE_DIR']
+    os.makedirs(profile_dir, exist_ok=True)
+    path = os.path.join(profile_dir, '{}.prof'.format(g.profile_id))
+    profile.dump_stats(path)
+    app.logger.info("Profiled %s %s to %s", request.method, request.path,
+                    path)
+    return path
+
+
+@bp.after_request
+def finish_profile(response):
+    """
+    Writes the profile of a profiled request to PROFILE_DIR, named by its
+    request ID, and adds a Server-Timing header with the time spent in
+    each pipeline stage.
+    """
+    if 'profile' not in g:
+        return response
+
+    total = time.perf_counter() - g.profile_start
+    _stop()
+    response.headers['X-Request-ID'] = g.profile_id
+    response.headers['Server-Timing'] = _server_timing(g.profile_stages,
+                                                       total)
+    return response
+
+
+@bp.teardown_request
+def abandon_profile(exc):
+    # after_request isn't called if the view raised
+    if 'profile' in g:
+        _stop()
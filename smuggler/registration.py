@@ -0,0 +1,105 @@
+import json
+import time
+from smuggler import app
+from smuggler.db import get_db, register_schema
+from smuggler.impala_session import get_session
+from smuggler.metadata import read_metadata, TrackMetadata
+from smuggler.metrics import stage
+from smuggler.tasks import moss_lock_holding
+
+# With DEFERRED_REGISTRATION, the parsed tags of each uploaded track wait
+# here until the holding is locked and registered in impala as a whole.
+register_schema("""
+CREATE TABLE IF NOT EXISTS staged_tracks (
+    hid TEXT NOT NULL,
+    path TEXT NOT NULL,
+    hgid TEXT NOT NULL,
+    fields TEXT NOT NULL,
+    created REAL NOT NULL,
+    PRIMARY KEY (hid, path)
+);
+""")
+
+
+def register_track(hgid, hid, tmpfname, path):
+    """
+    Registers a spooled track in impala, or with DEFERRED_REGISTRATION only
+    records its tags until lock_holding() is called.
+    """
+    if not app.config['DEFERRED_REGISTRATION']:
+        get_session().create_track(hgid, hid, tmpfname, path)
+        return
+
+    with stage('tag_parse'):
+        item = read_metadata(tmpfname)
+    if item is None:
+        return
+
+    get_db().execute('INSERT OR REPLACE INTO staged_tracks '
+                     '(hid, path, hgid, fields, created) '
+                     'VALUES (?, ?, ?, ?, ?)',
+                     (str(hid), path, str(hgid),
+                      json.dumps(item.fields, default=str), time.time()))
+
+
+def staged_tracks(hid):
+    """
+    Returns the holding group IDs and (path, TrackMetadata) pairs staged
+    for a holding.
+    """
+    rows = get_db().execute('SELECT * FROM staged_tracks WHERE hid = ?',
+                            (str(hid),)).fetchall()
+    hgids = sorted({row['hgid'] for row in rows})
+    tracks = [(row['path'], TrackMetadata(json.loads(row['fields'])))
+              for row in rows]
+    return hgids, tracks
+
+
+def discard(hid):
+    get_db().execute('DELETE FROM staged_tracks WHERE hid = ?', (str(hid),))
+
+
+def expire_staged():
+    """
+    Drops staged tracks of holdings that were never locked within
+    STAGED_TRACK_TTL seconds.
+    """
+    cutoff = time.time() - app.config['STAGED_TRACK_TTL']
+    get_db().execute('DELETE FROM staged_tracks WHERE hid IN '
+                     '(SELECT hid FROM staged_tracks GROUP BY hid '
+                     'HAVING MAX(created) < ?)', (cutoff,))
+
+
+class HoldingGroupConflict(Exception):
+    """
+    Raised when the tracks staged for a holding name more than one holding
+    group, so it can't be registered.
+    """
+
+
+def lock_holding(hid):
+    """
+    Locks a holding in moss. Any tracks staged for it are registered in
+    impala first, and that registration is undone if moss can't be locked,
+    so the holding ends up either complete or absent in impala. Staged
+    tracks are kept after a failure so that the lock can be retried.
+    """
+    session = get_session()
+    hgids, tracks = staged_tracks(hid)
+    created = []
+    if tracks:
+        if len(hgids) > 1:
+            raise HoldingGroupConflict(
+                "Tracks of holding {} were uploaded to more than one holding "
+                "group".format(hid))
+        with stage('impala_register'):
+            created = session.register_holding(hgids[0], hid, tracks)
+
+    try:
+        moss_lock_holding(hid)
+    except:
+        session.rollback(created)
+        session.forget_holding(hid, hgids[0] if hgids else None)
+        raise
+
+    discard(hid)
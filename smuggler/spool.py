@@ -0,0 +1,148 @@
+import hashlib
+import shutil
+import tempfile
+import uuid
+from functools import wraps
+from flask import request, Response
+from smuggler import app
+from smuggler.db import get_db, register_schema, process_id
+from smuggler.db import expire_processes
+from smuggler.metrics import stage, SPOOL_ADMISSIONS, UPLOADS_IN_FLIGHT
+
+# Bytes promised to upload bodies that are still arriving, by the worker
+# receiving them. Shared through the state database so that every worker
+# leaves room for the others' uploads.
+register_schema("""
+CREATE TABLE IF NOT EXISTS spool_reservations (
+    id TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    bytes INTEGER NOT NULL
+);
+""")
+
+# Counters since this worker started, for monitoring
+stats = {
+    'admitted': 0,
+    'rejected': 0,
+    'reclaimed_files': 0,
+    'reclaimed_bytes': 0,
+}
+
+
+class SpoolFile:
+    """
+    A request body that has been written to disk under TEMP_DIR, along with
+    its size and the checksum computed while it was being written.
+    """
+    def __init__(self, name, size, sha256):
+        self.name = name
+        self.size = size
+        self.sha256 = sha256
+
+
+def spool_stream(stream):
+    """
+    Copies a file-like stream to a new temporary file in fixed-size chunks,
+    hashing it as it goes, so that memory use stays bounded no matter how
+    large the body is. Returns a SpoolFile; the caller owns the file.
+    """
+    chunk_size = app.config['SPOOL_CHUNK_SIZE']
+    checksum = hashlib.sha256()
+    size = 0
+
+    f = tempfile.NamedTemporaryFile(dir=app.config['TEMP_DIR'], delete=False,
+                                    mode='wb')
+    with stage('spool'), f:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            f.write(chunk)
+            checksum.update(chunk)
+            size += len(chunk)
+
+    return SpoolFile(f.name, size, checksum.hexdigest())
+
+
+def free_space():
+    """
+    Returns the free bytes on the TEMP_DIR filesystem, less what the workers
+    have reserved for bodies that are still being received.
+    """
+    reserved = get_db().execute('SELECT COALESCE(SUM(bytes), 0) '
+                                'FROM spool_reservations').fetchone()[0]
+    return shutil.disk_usage(app.config['TEMP_DIR']).free - reserved
+
+
+def has_room(length):
+    """
+    Returns whether length more bytes can be spooled without leaving less
+    than MIN_FREE_SPACE free.
+    """
+    return free_space() - length >= app.config['MIN_FREE_SPACE']
+
+
+def reserve_space(length):
+    """
+    Reserves length bytes of spool space if there is room for them, and
+    returns the reservation's ID, or None if there isn't.
+    """
+    # The lease has to exist before the transaction can take it
+    owner = process_id()
+    db = get_db()
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        # Reservations of workers that have died would never be released
+        expire_processes(db)
+        db.execute('DELETE FROM spool_reservations '
+                   'WHERE owner NOT IN (SELECT id FROM processes)')
+        reservation = None
+        if has_room(length):
+            reservation = str(uuid.uuid4())
+            db.execute('INSERT INTO spool_reservations (id, owner, bytes) '
+                       'VALUES (?, ?, ?)', (reservation, owner, length))
+        db.execute('COMMIT')
+    except:
+        db.execute('ROLLBACK')
+        raise
+
+    if reservation is None:
+        stats['rejected'] += 1
+        SPOOL_ADMISSIONS.labels('rejected').inc()
+    else:
+        stats['admitted'] += 1
+        SPOOL_ADMISSIONS.labels('admitted').inc()
+    return reservation
+
+
+def release_space(reservation):
+    get_db().execute('DELETE FROM spool_reservations WHERE id = ?',
+                     (reservation,))
+
+
+def insufficient_space():
+    """Sends a 503 response asking the client to come back later"""
+    return Response(
+        'Not enough spool space to accept this upload right now.\n', 503,
+        {'Retry-After': str(app.config['SPOOL_RETRY_AFTER'])})
+
+
+def requires_spool_space(f):
+    """
+    Refuses an upload before its body is read if spooling it would leave
+    less than MIN_FREE_SPACE free in TEMP_DIR. The body's Content-Length
+    stays reserved, in the state database that every worker checks, until
+    the view returns; chunked bodies reserve nothing but are still refused
+    once the disk is past the threshold.
+    """
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        reservation = reserve_space(request.content_length or 0)
+        if reservation is None:
+            return insufficient_space()
+        try:
+            with UPLOADS_IN_FLIGHT.track_inprogress():
+                return f(*args, **kwargs)
+        finally:
+            release_space(reservation)
+    return decorated
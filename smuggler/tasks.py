@@ -1,35 +1,170 @@
+import base64
+import http.client
+import os
+import threading
 from os.path import join
 import requests
-from urllib.parse import urljoin, quote
-from smuggler import app
+from requests.adapters import HTTPAdapter
+from urllib.parse import urljoin, urlparse, quote, unquote
+from smuggler import app, upstream
+from smuggler.metrics import stage, MOSS_REQUESTS, MOSS_BYTES
 
+_session = None
+_session_lock = threading.Lock()
+_connections = threading.local()
 
-def moss_create_track(hid, tmpfname, path):
+
+def _moss_session():
+    """
+    Returns this worker's pooled requests session for moss.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1,
+                                  pool_maxsize=app.config['INGEST_THREADS'])
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+        return _session
+
+
+def _reset_session():
+    global _session, _session_lock, _connections
+    _session = None
+    _session_lock = threading.Lock()
+    _connections = threading.local()
+
+
+os.register_at_fork(after_in_child=_reset_session)
+
+
+def _connection(host, port):
+    """
+    Returns this thread's keep-alive connection to moss for sendfile PUTs.
+    """
+    conns = _connections.__dict__.setdefault('conns', {})
+    conn = conns.get((host, port))
+    if conn is None:
+        conn = conns[(host, port)] = http.client.HTTPConnection(
+            host, port, timeout=app.config['UPSTREAM_TIMEOUT'])
+    return conn
+
+
+def _sendfile_put(endpoint, f, headers, timeout):
+    """
+    PUTs an open file over plain HTTP, handing the body to the kernel with
+    sendfile() so it is never copied through userspace. Returns the status.
+    """
+    url = urlparse(endpoint)
+    target = url.path + ('?' + url.query if url.query else '')
+    if url.username is not None:
+        credentials = '{}:{}'.format(unquote(url.username),
+                                     unquote(url.password or ''))
+        headers['Authorization'] = 'Basic ' + base64.b64encode(
+            credentials.encode()).decode()
+
+    conn = _connection(url.hostname, url.port or 80)
+    conn.timeout = timeout
+    if conn.sock is not None:
+        conn.sock.settimeout(timeout)
+    # A pooled connection may have been closed by moss while idle; PUT is
+    # idempotent, so try once more on a fresh one
+    for attempt in range(2):
+        try:
+            conn.putrequest('PUT', target, skip_accept_encoding=True)
+            for key, value in headers.items():
+                conn.putheader(key, value)
+            conn.endheaders()
+            conn.sock.sendfile(f, offset=0)
+            r = conn.getresponse()
+            r.read()
+            return r.status
+        except (ConnectionError, http.client.HTTPException):
+            conn.close()
+            if attempt:
+                raise
+        except:
+            # Don't leave a half-sent request on a connection we'll reuse
+            conn.close()
+            raise
+
+
+def _moss_put(endpoint, path=None, sha256=None):
+    """
+    PUTs a file, or nothing, to moss and raises if moss refuses it. Files
+    are sent straight from disk, with Content-Length taken from fstat() and,
+    if MOSS_SEND_DIGEST is set and sha256 is given, a Digest header.
+    Transient failures are retried by sending the same file again.
+    """
+    headers = {}
+    if sha256 and app.config['MOSS_SEND_DIGEST']:
+        headers['Digest'] = 'sha-256=' + base64.b64encode(
+            bytes.fromhex(sha256)).decode()
+    sendfile = app.config['MOSS_SENDFILE'] and \
+        urlparse(endpoint).scheme == 'http'
+
+    f = open(path, 'rb') if path is not None else None
+    if f is not None:
+        size = os.fstat(f.fileno()).st_size
+        headers['Content-Length'] = str(size)
+
+    def send(timeout):
+        if f is None:
+            status = _moss_session().put(endpoint, headers=headers,
+                                         timeout=timeout).status_code
+        elif sendfile:
+            status = _sendfile_put(endpoint, f, dict(headers), timeout)
+        else:
+            # Passing the file object lets requests stream it from disk
+            f.seek(0)
+            status = _moss_session().put(endpoint, data=f, headers=headers,
+                                         timeout=timeout).status_code
+        MOSS_REQUESTS.labels(status).inc()
+        return status
+
+    try:
+        status = upstream.moss.call(send, status=lambda status: status)
+    finally:
+        if f is not None:
+            f.close()
+
+    if status < 200 or status >= 300:
+        raise IOError("Got {} from moss".format(status))
+    if path is not None:
+        MOSS_BYTES.inc(size)
+
+
+def moss_create_track(hid, tmpfname, path, sha256=None):
     """
     Uploads the file to moss at the path within a holding's UUID. If it
     fails, raises an exception.
     """
     moss_uri = app.config['MOSS_URI']
     endpoint = urljoin(moss_uri, join(str(hid), 'music', quote(path)))
-    with open(tmpfname, 'rb') as f:
-        data = f.read()
-        r = requests.put(endpoint, data=data)
-        if r.status_code < 200 or r.status_code >= 300:
-            raise IOError("Got {} from moss".format(r.status_code))
+    with stage('moss_track'):
+        _moss_put(endpoint, tmpfname, sha256)
 
 
-def moss_create_albumart(hid, path):
+def albumart_key(hid, size=None):
     """
-    Uploads the album art to moss for the holding's UUID. If it fails, raises
-    an exception.
+    Returns where in moss a holding's album art is kept, or if size is given,
+    its derivative of that size. Derivatives are siblings of the original
+    rather than under it, since the original's key can't also be a prefix.
     """
-    moss_uri = app.config['MOSS_URI']
-    endpoint = urljoin(moss_uri, join(str(hid), 'albumart'))
-    with open(path, 'rb') as f:
-        data = f.read()
-        r = requests.put(endpoint, data=data)
-        if r.status_code < 200 or r.status_code >= 300:
-            raise IOError("Got {} from moss".format(r.status_code))
+    if size is None:
+        return join(str(hid), 'albumart')
+    return join(str(hid), 'albumart-{}'.format(size))
+
+
+def moss_create_albumart(hid, path, size=None):
+    """
+    Uploads the album art to moss for the holding's UUID, or if size is
+    given, its derivative of that size. If it fails, raises an exception.
+    """
+    endpoint = urljoin(app.config['MOSS_URI'], albumart_key(hid, size))
+    with stage('moss_albumart'):
+        _moss_put(endpoint, path)
 
 
 def moss_lock_holding(hid):
@@ -39,6 +174,5 @@ def moss_lock_holding(hid):
     """
     moss_uri = app.config['MOSS_URI']
     endpoint = urljoin(moss_uri, join(str(hid), 'lock'))
-    r = requests.put(endpoint)
-    if r.status_code < 200 or r.status_code >= 300:
-        raise IOError("Got {} from moss".format(r.status_code))
+    with stage('moss_lock'):
+        _moss_put(endpoint)
@@ -0,0 +1,48 @@
+import time
+from smuggler.db import get_db, register_schema
+
+# Which holding has a torrent, or NULL if none had it when impala was last
+# asked. Shared by every worker so that a torrent hash set through one of
+# them is seen by all the others straight away.
+register_schema("""
+CREATE TABLE IF NOT EXISTS torrent_cache (
+    infohash TEXT PRIMARY KEY,
+    hid TEXT,
+    expires REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS torrent_cache_hid ON torrent_cache (hid);
+CREATE INDEX IF NOT EXISTS torrent_cache_expires ON torrent_cache (expires);
+""")
+
+
+def lookup(infohash):
+    """
+    Returns (True, hid) for a live entry, where hid may be None, or
+    (False, None) on a miss.
+    """
+    row = get_db().execute('SELECT hid FROM torrent_cache '
+                           'WHERE infohash = ? AND expires > ?',
+                           (infohash, time.time())).fetchone()
+    if row is None:
+        return False, None
+    return True, row['hid']
+
+
+def record(infohash, hid, ttl):
+    get_db().execute('INSERT OR REPLACE INTO torrent_cache '
+                     '(infohash, hid, expires) VALUES (?, ?, ?)',
+                     (infohash, hid, time.time() + ttl))
+
+
+def forget(infohash, hid):
+    """
+    Drops what we know about a torrent and about every torrent said to
+    belong to a holding.
+    """
+    get_db().execute('DELETE FROM torrent_cache WHERE infohash = ? OR hid = ?',
+                     (infohash, str(hid)))
+
+
+def expire():
+    get_db().execute('DELETE FROM torrent_cache WHERE expires <= ?',
+                     (time.time(),))
@@ -0,0 +1,234 @@
+import hashlib
+import os
+import tempfile
+import time
+import uuid
+from smuggler import app
+from smuggler.db import get_db, register_schema
+from smuggler.spool import SpoolFile
+
+# Resumable uploads are staged in TEMP_DIR and described here, so that any
+# worker process can accept the next chunk of an upload.
+register_schema("""
+CREATE TABLE IF NOT EXISTS upload_sessions (
+    id TEXT PRIMARY KEY,
+    hgid TEXT NOT NULL,
+    hid TEXT NOT NULL,
+    path TEXT NOT NULL,
+    length INTEGER NOT NULL,
+    offset INTEGER NOT NULL DEFAULT 0,
+    tmpfname TEXT NOT NULL,
+    locked_until REAL NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+""")
+
+# The running checksum of each upload's staged bytes, as (offset, sha256),
+# kept by the worker process that received them
+_checksums = {}
+
+
+def _reset_checksums():
+    _checksums.clear()
+
+
+os.register_at_fork(after_in_child=_reset_checksums)
+
+
+class UploadConflict(Exception):
+    """
+    Raised when a chunk doesn't start at the upload's current offset, or
+    another request is already writing to the same upload.
+    """
+    def __init__(self, message, offset):
+        super().__init__(message)
+        self.offset = offset
+
+
+def _session_dict(row):
+    return {'id': row['id'],
+            'hgid': row['hgid'],
+            'hid': row['hid'],
+            'path': row['path'],
+            'length': row['length'],
+            'offset': row['offset'],
+            'tmpfname': row['tmpfname'],
+            'created': row['created'],
+            'updated': row['updated']}
+
+
+def create_session(hgid, hid, path, length):
+    """
+    Starts a resumable upload of length bytes and returns its session.
+    """
+    expire_sessions()
+
+    f = tempfile.NamedTemporaryFile(dir=app.config['TEMP_DIR'],
+                                    prefix='upload', delete=False)
+    f.close()
+
+    upload_id = str(uuid.uuid4())
+    now = time.time()
+    get_db().execute(
+        'INSERT INTO upload_sessions (id, hgid, hid, path, length, tmpfname, '
+        'created, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+        (upload_id, str(hgid), str(hid), path, length, f.name, now, now))
+    return get_session(upload_id)
+
+
+def get_session(upload_id):
+    """
+    Returns an upload session as a dict, or None if there is no such upload.
+    """
+    row = get_db().execute('SELECT * FROM upload_sessions WHERE id = ?',
+                           (upload_id,)).fetchone()
+    if row is None:
+        return None
+    return _session_dict(row)
+
+
+def delete_session(upload_id):
+    session = get_session(upload_id)
+    if session is None:
+        return
+    get_db().execute('DELETE FROM upload_sessions WHERE id = ?', (upload_id,))
+    _checksums.pop(upload_id, None)
+    try:
+        os.unlink(session['tmpfname'])
+    except FileNotFoundError:
+        pass
+
+
+def expire_sessions():
+    """
+    Removes uploads that haven't received a chunk within UPLOAD_SESSION_TTL
+    seconds, along with their staging files.
+    """
+    cutoff = time.time() - app.config['UPLOAD_SESSION_TTL']
+    rows = get_db().execute('SELECT id FROM upload_sessions '
+                            'WHERE updated < ? AND locked_until < ?',
+                            (cutoff, time.time())).fetchall()
+    for row in rows:
+        delete_session(row['id'])
+
+    # Uploads finished or expired through another worker process
+    live = {row['id'] for row in
+            get_db().execute('SELECT id FROM upload_sessions').fetchall()}
+    for upload_id in list(_checksums):
+        if upload_id not in live:
+            _checksums.pop(upload_id, None)
+
+
+def _lock(upload_id, offset):
+    db = get_db()
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        row = db.execute('SELECT * FROM upload_sessions WHERE id = ?',
+                         (upload_id,)).fetchone()
+        if row is None:
+            db.execute('ROLLBACK')
+            return None
+        if row['locked_until'] > time.time():
+            raise UploadConflict("Upload is being written to", row['offset'])
+        if row['offset'] != offset:
+            raise UploadConflict("Chunk does not start at the upload offset",
+                                 row['offset'])
+        db.execute('UPDATE upload_sessions SET locked_until = ? WHERE id = ?',
+                   (time.time() + app.config['UPLOAD_CHUNK_TIMEOUT'],
+                    upload_id))
+        db.execute('COMMIT')
+    except:
+        db.execute('ROLLBACK')
+        raise
+    return _session_dict(row)
+
+
+def _checksum(session, offset):
+    """
+    Returns the running checksum of an upload's first offset bytes. If the
+    previous chunk went to another worker process they are hashed here to
+    catch up, once.
+    """
+    entry = _checksums.get(session['id'])
+    if entry is not None and entry[0] == offset:
+        return entry[1]
+
+    chunk_size = app.config['SPOOL_CHUNK_SIZE']
+    checksum = hashlib.sha256()
+    remaining = offset
+    with open(session['tmpfname'], 'rb') as f:
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            checksum.update(chunk)
+            remaining -= len(chunk)
+    return checksum
+
+
+def append_chunk(upload_id, offset, stream):
+    """
+    Writes a chunk read from stream into the staging file at offset, which
+    must be the upload's current offset, hashing it as it goes. Data already
+    staged is only read back when the previous chunk went to another worker
+    process. Returns the updated session, or None if there is no such upload.
+    Anything received before the stream failed is kept, so the client can
+    resume from the new offset.
+
+    Once the last byte has arrived the upload stays locked, so that only
+    this request goes on to ingest it; call unlock() if that fails.
+    """
+    session = _lock(upload_id, offset)
+    if session is None:
+        return None
+
+    chunk_size = app.config['SPOOL_CHUNK_SIZE']
+    remaining = session['length'] - offset
+    written = 0
+    try:
+        checksum = _checksum(session, offset)
+        with open(session['tmpfname'], 'r+b') as f:
+            f.seek(offset)
+            while remaining > 0:
+                chunk = stream.read(min(chunk_size, remaining))
+                if not chunk:
+                    break
+                f.write(chunk)
+                checksum.update(chunk)
+                written += len(chunk)
+                remaining -= len(chunk)
+        _checksums[upload_id] = (offset + written, checksum)
+    finally:
+        complete = remaining == 0
+        get_db().execute('UPDATE upload_sessions SET offset = ?, '
+                         'locked_until = CASE WHEN ? THEN locked_until '
+                         'ELSE 0 END, updated = ? WHERE id = ?',
+                         (offset + written, complete, time.time(), upload_id))
+
+    session['offset'] = offset + written
+    return session
+
+
+def unlock(upload_id):
+    get_db().execute('UPDATE upload_sessions SET locked_until = 0 '
+                     'WHERE id = ?', (upload_id,))
+
+
+def complete_spool(session):
+    """
+    Returns a SpoolFile for a fully received upload, using the checksum
+    kept as its chunks were appended.
+    """
+    checksum = _checksum(session, session['length'])
+    return SpoolFile(session['tmpfname'], session['length'],
+                     checksum.hexdigest())
+
+
+def release_session(upload_id):
+    """
+    Forgets an upload session once its staging file has been handed over to
+    something else that will remove it.
+    """
+    get_db().execute('DELETE FROM upload_sessions WHERE id = ?', (upload_id,))
+    _checksums.pop(upload_id, None)
@@ -0,0 +1,246 @@
+import http.client
+import os
+import random
+import socket
+import threading
+import time
+from functools import wraps
+import requests
+from flask import Response
+from smuggler import app
+from smuggler.metrics import UPSTREAM_RETRIES, CIRCUIT_OPENED
+
+# Statuses that mean the upstream, not our request, is having a bad time
+RETRY_STATUSES = [500, 502, 503, 504]
+
+# Failures of a single attempt that are worth another try
+RETRY_EXCEPTIONS = (ConnectionError, TimeoutError, socket.timeout,
+                    http.client.HTTPException, requests.ConnectionError,
+                    requests.Timeout)
+
+
+class UpstreamUnavailable(IOError):
+    """
+    Raised when an upstream's circuit is open, or it kept failing until we
+    ran out of attempts or time. Sent to clients as a 503.
+    """
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _timeout(deadline):
+    """
+    Returns the timeout for an attempt that must finish by deadline.
+    """
+    return max(0.001, min(app.config['UPSTREAM_TIMEOUT'],
+                          deadline - time.monotonic()))
+
+
+class Upstream:
+    """
+    Makes calls to one upstream, retrying idempotent requests that failed
+    in a transient way with jittered exponential backoff, for up to
+    UPSTREAM_RETRIES retries and UPSTREAM_DEADLINE seconds in all. Each
+    attempt is given a timeout that doesn't run past the deadline.
+
+    Also a circuit breaker: once CIRCUIT_FAILURE_THRESHOLD calls in a row
+    have failed, further calls fail immediately for CIRCUIT_RESET_TIMEOUT
+    seconds, after which one call at a time is let through to test whether
+    the upstream has recovered. Safe to share between threads.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self._lock = threading.Lock()
+
+    def retry_after(self):
+        """
+        Returns how many seconds until the circuit will let a call through,
+        or 0 if it is closed.
+        """
+        with self._lock:
+            if self.opened_at is None:
+                return 0
+            remaining = self.opened_at + \
+                app.config['CIRCUIT_RESET_TIMEOUT'] - time.monotonic()
+            if remaining <= 0 and not self.trial:
+                return 0
+            return max(1, int(remaining + 0.5))
+
+    def _allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            reset = self.opened_at + app.config['CIRCUIT_RESET_TIMEOUT']
+            if time.monotonic() < reset or self.trial:
+                return False
+            self.trial = True
+            return True
+
+    def _succeeded(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def _failed(self):
+        with self._lock:
+            self.failures += 1
+            if self.trial or \
+                    self.failures >= app.config['CIRCUIT_FAILURE_THRESHOLD']:
+                if self.opened_at is None or self.trial:
+                    CIRCUIT_OPENED.labels(self.name).inc()
+                    app.logger.warning("%s is failing; circuit opened",
+                                       self.name)
+                self.opened_at = time.monotonic()
+            self.trial = False
+
+    def _inconclusive(self):
+        # The call failed for reasons of our own, which say nothing about
+        # the upstream, but a trial call must still make way for another
+        with self._lock:
+            self.trial = False
+
+    def _unavailable(self, reason):
+        return UpstreamUnavailable(
+            "{} is unavailable: {}".format(self.name, reason),
+            self.retry_after() or app.config['CIRCUIT_RESET_TIMEOUT'])
+
+    def _delays(self, deadline):
+        """
+        Yields how long to sleep before each retry, stopping when retries
+        or the deadline run out.
+        """
+        backoff = app.config['UPSTREAM_BACKOFF']
+        for attempt in range(app.config['UPSTREAM_RETRIES']):
+            delay = min(backoff * 2 ** attempt,
+                        app.config['UPSTREAM_MAX_BACKOFF'])
+            delay *= random.uniform(0.5, 1.5)
+            if time.monotonic() + delay >= deadline:
+                return
+            yield delay
+
+    def _transient(self, result, error, status):
+        """
+        Returns whether an attempt failed in a way worth retrying.
+        """
+        if error is not None:
+            return isinstance(error, RETRY_EXCEPTIONS)
+        return status(result) in RETRY_STATUSES
+
+    def _finish(self, result, error, status):
+        if error is not None and not isinstance(error, RETRY_EXCEPTIONS):
+            self._inconclusive()
+            raise error
+        if error is not None:
+            self._failed()
+            raise self._unavailable(error) from error
+        if status(result) in RETRY_STATUSES:
+            self._failed()
+            raise self._unavailable("got {}".format(status(result)))
+        self._succeeded()
+        return result
+
+    def call(self, send, idempotent=True, status=lambda r: r.status_code):
+        """
+        Returns send(timeout), retried while it raises a connection error
+        or returns a response whose status() is a 5xx. send must not wait
+        on the network for longer than timeout seconds at a time. Raises
+        UpstreamUnavailable if the circuit is open or every attempt failed
+        in one of those ways.
+        """
+        if not self._allow():
+            raise self._unavailable("circuit open")
+
+        deadline = time.monotonic() + app.config['UPSTREAM_DEADLINE']
+        delays = self._delays(deadline) if idempotent else iter(())
+        while True:
+            result = error = None
+            try:
+                result = send(_timeout(deadline))
+            except Exception as e:
+                error = e
+            if not self._transient(result, error, status):
+                break
+            delay = next(delays, None)
+            if delay is None:
+                break
+            UPSTREAM_RETRIES.labels(self.name).inc()
+            time.sleep(delay)
+
+        return self._finish(result, error, status)
+
+    async def acall(self, send, idempotent=True,
+                    status=lambda r: r.status_code):
+        """
+        The same as call(), for a coroutine function send.
+        """
+        # Only the ASGI app needs asyncio; WSGI workers don't pay to load it
+        import asyncio
+
+        if not self._allow():
+            raise self._unavailable("circuit open")
+
+        deadline = time.monotonic() + app.config['UPSTREAM_DEADLINE']
+        delays = self._delays(deadline) if idempotent else iter(())
+        while True:
+            result = error = None
+            try:
+                result = await send(_timeout(deadline))
+            except Exception as e:
+                error = e
+            if not self._transient(result, error, status):
+                break
+            delay = next(delays, None)
+            if delay is None:
+                break
+            UPSTREAM_RETRIES.labels(self.name).inc()
+            await asyncio.sleep(delay)
+
+        return self._finish(result, error, status)
+
+
+moss = Upstream('moss')
+impala = Upstream('impala')
+
+
+def _reset_upstreams():
+    # Each worker judges the upstreams for itself, with its own locks
+    global moss, impala
+    moss = Upstream('moss')
+    impala = Upstream('impala')
+
+
+os.register_at_fork(after_in_child=_reset_upstreams)
+
+
+def check_available():
+    """
+    Raises UpstreamUnavailable if the circuit of either upstream is open.
+    """
+    for upstream in [moss, impala]:
+        if upstream.retry_after():
+            raise upstream._unavailable("circuit open")
+
+
+def requires_upstreams(f):
+    """
+    Refuses an upload before its body is read while moss or impala is known
+    to be down, rather than spooling a file we can't store. Uploads that
+    will be queued for the background workers are still accepted.
+    """
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        if not app.config['ASYNC_INGEST']:
+            check_available()
+        return f(*args, **kwargs)
+    return decorated
+
+
+@app.errorhandler(UpstreamUnavailable)
+def upstream_unavailable(e):
+    """Sends a 503 response asking the client to come back later"""
+    return Response(str(e) + '\n', 503, {'Retry-After': str(e.retry_after)})